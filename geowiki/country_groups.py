@@ -0,0 +1,130 @@
+'''
+
+Local cache of the regional classification of countries.
+
+`scripts/make_limn_files.py` groups countries by the "List of countries by
+regional classification" table on meta.wikimedia.org. The table is cached in
+a json file together with its content hash and the parsed
+{grouping : {country : group name}} mapping, so that
+
+* runs within `ttl` seconds of the last fetch do not touch the network,
+* runs without network access fall back to the cached copy, and
+* callers can tell from the hash whether the mapping actually changed.
+
+The mapping has the format `process_data.py --country_groups` takes, and
+`load_groups` reads it from either a cache file or a plain mapping file.
+
+'''
+
+import hashlib
+import json
+import logging
+import math
+import os
+import tempfile
+import time
+
+try:
+    import wikipandas
+except ImportError:
+    wikipandas = None
+
+logger = logging.getLogger(__name__)
+
+CLASSIFICATION_TITLE = 'List of countries by regional classification'
+CLASSIFICATION_SITE = 'meta.wikimedia.org'
+
+COUNTRY_FIELD = 'Country'
+GROUPINGS = ['Global South', 'Region']
+
+DEFAULT_CACHE_FN = os.path.join(os.path.expanduser('~'), '.cache', 'geowiki', 'country_classification.json')
+DEFAULT_TTL = 24 * 3600
+
+
+def fetch_table():
+    '''Returns the rows of the classification table on meta as a list of dicts'''
+    if wikipandas is None:
+        raise ImportError('fetching the country classification requires the wikipandas module')
+    df = wikipandas.get_table(title=CLASSIFICATION_TITLE, site=CLASSIFICATION_SITE, table_idx=0)
+    rows = []
+    for idx, series in df.iterrows():
+        rows.append(dict((k, None if isinstance(v, float) and math.isnan(v) else v) for (k, v) in dict(series).iteritems()))
+    return rows
+
+
+def content_hash(rows):
+    return hashlib.sha1(json.dumps(rows, sort_keys=True)).hexdigest()
+
+
+def make_groups(rows, groupings=GROUPINGS):
+    '''Returns {grouping : {country : group name}} for the classification `rows`'''
+    groups = {}
+    for grouping in groupings:
+        groups[grouping] = dict((row[COUNTRY_FIELD], row[grouping]) for row in rows
+                                if row.get(COUNTRY_FIELD) is not None and row.get(grouping) is not None)
+    return groups
+
+
+def load_cache(cache_fn):
+    if not os.path.exists(cache_fn):
+        return None
+    try:
+        return json.load(open(cache_fn))
+    except ValueError:
+        logger.warning('ignoring corrupt country classification cache: %s', cache_fn)
+        return None
+
+
+def save_cache(cache_fn, cache):
+    cache_dir = os.path.dirname(cache_fn) or '.'
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir)
+    (fd, tmp_fn) = tempfile.mkstemp(dir=cache_dir, prefix='.%s.' % os.path.basename(cache_fn))
+    with os.fdopen(fd, 'w') as f:
+        json.dump(cache, f)
+    os.rename(tmp_fn, cache_fn)
+
+
+def get_classification(cache_fn=DEFAULT_CACHE_FN, ttl=DEFAULT_TTL, offline=False):
+    '''Returns (rows, groups, changed) for the country classification.
+
+    The cached copy in `cache_fn` is used if it is younger than `ttl`
+    seconds, if `offline` is set, or if fetching the table fails. `changed`
+    is True if the fetched table differs from the cached one, i.e. if
+    anything grouped by it has to be recomputed.
+    '''
+    cache = load_cache(cache_fn)
+    if cache is not None and (offline or time.time() - cache['fetched'] < ttl):
+        logger.debug('using cached country classification from %s', cache_fn)
+        return cache['rows'], cache['groups'], False
+    if offline:
+        raise IOError('no cached country classification in %s' % cache_fn)
+
+    try:
+        rows = fetch_table()
+    except Exception:
+        if cache is None:
+            raise
+        logger.warning('could not fetch the country classification, using the cached copy from %s',
+                       time.ctime(cache['fetched']), exc_info=True)
+        return cache['rows'], cache['groups'], False
+
+    digest = content_hash(rows)
+    changed = cache is None or cache['hash'] != digest
+    if changed:
+        logger.info('country classification changed, regrouping')
+        groups = make_groups(rows)
+    else:
+        groups = cache['groups']
+    save_cache(cache_fn, {'fetched': time.time(), 'hash': digest, 'rows': rows, 'groups': groups})
+    return rows, groups, changed
+
+
+def load_groups(fn):
+    '''Returns the {grouping : {country : group name}} mapping of `fn`, either
+    a classification cache file or a plain mapping
+    '''
+    data = json.load(open(fn))
+    if 'groups' in data and 'hash' in data:
+        return data['groups']
+    return data
@@ -0,0 +1,183 @@
+'''
+
+Compact columnar binary format for the filtered (user, ip) rows of a project.
+
+With `--write_extract`, `process_data` writes the rows it aggregated (bots
+already removed) next to its other output. `--source extract` reads them back
+zero-copy through `numpy.memmap`, so new cohort definitions or GeoIP versions
+can be recomputed locally without querying the replicas again.
+
+Layout of a file:
+
+    8 bytes     magic, `GEOWIKI1`
+    4 bytes     little-endian uint32, length of the JSON header
+    n bytes     JSON header: project, start, end, rows and the
+                [name, dtype] pairs of the columns, padded with spaces to a
+                multiple of 8 bytes
+    ...         one contiguous little-endian array per column, in header order
+
+The columns are `user` (uint32 user id), `ip` (uint32 IPv4 address, 0 if the
+ip could not be parsed) and `timestamp` (uint32 seconds since the epoch, 0 if
+unknown).
+
+'''
+
+import array
+import calendar
+import json
+import logging
+import os
+import shutil
+import struct
+import sys
+import tempfile
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+import geocode_cache
+import mysql_config
+
+logger = logging.getLogger(__name__)
+
+MAGIC = 'GEOWIKI1'
+
+COLUMNS = [
+    ('user', 'uint32'),
+    ('ip', 'uint32'),
+    ('timestamp', 'uint32'),
+]
+
+# rows buffered in memory before they are appended to the column files
+BUFFER_ROWS = 1 << 16
+
+
+def get_extract_fn(wp_pr, opts):
+    dt_fmt = '%Y%m%d'
+    return '%s.bin' % '_'.join([
+        opts['basename'],
+        wp_pr,
+        'extract',
+        opts['start'].strftime(dt_fmt),
+        opts['end'].strftime(dt_fmt)])
+
+
+def parse_timestamp(ts):
+    '''Returns the seconds since the epoch of the MediaWiki timestamp `ts`, e.g. `20130525123000`'''
+    if not ts:
+        return 0
+    return calendar.timegm((int(ts[0:4]), int(ts[4:6]), int(ts[6:8]),
+                            int(ts[8:10]), int(ts[10:12]), int(ts[12:14]), 0, 0, 0))
+
+
+class ExtractWriter(object):
+    '''Writes rows with the columns of `mysql_config.CU_FIELDS` to the extract
+    file `fn`. Columns are buffered in arrays and appended to one temporary
+    file per column; `close` assembles the final file and renames it into
+    place, so readers never see a partial file. `abort` removes the temporary
+    files of a writer that failed.
+    '''
+
+    def __init__(self, fn, wp_pr, opts):
+        self.fn = fn
+        self.header = {
+            'project': wp_pr,
+            'start': opts['start'].isoformat(),
+            'end': opts['end'].isoformat(),
+            'columns': COLUMNS,
+        }
+        self.rows = 0
+        self.tmpdir = tempfile.mkdtemp(dir=os.path.dirname(fn) or '.')
+        self.column_files = [open(os.path.join(self.tmpdir, name), 'wb') for (name, dtype) in COLUMNS]
+        self.buffers = [array.array('I') for c in COLUMNS]
+        self.user_idx = mysql_config.CU_FIELDS.index('cuc_user')
+        self.ip_idx = mysql_config.CU_FIELDS.index('cuc_ip')
+        self.ts_idx = mysql_config.CU_FIELDS.index('cuc_timestamp')
+
+    def write(self, row):
+        (users, ips, timestamps) = self.buffers
+        users.append(row[self.user_idx])
+        ips.append(geocode_cache.ip_to_int(row[self.ip_idx]) or 0)
+        timestamps.append(parse_timestamp(row[self.ts_idx]))
+        self.rows += 1
+        if len(users) >= BUFFER_ROWS:
+            self.flush()
+
+    def tee(self, rows, keep=None):
+        '''Writes each of `rows` for which `keep(row)` is true, or all of them
+        if `keep` is None, and yields every row on
+        '''
+        for row in rows:
+            if keep is None or keep(row):
+                self.write(row)
+            yield row
+
+    def flush(self):
+        for (buf, f) in zip(self.buffers, self.column_files):
+            if sys.byteorder != 'little':
+                buf.byteswap()
+            buf.tofile(f)
+            del buf[:]
+
+    def close(self):
+        try:
+            self.flush()
+            for f in self.column_files:
+                f.close()
+            self.header['rows'] = self.rows
+            header = json.dumps(self.header)
+            header += ' ' * (-len(header) % 8)
+
+            tmp_fn = os.path.join(self.tmpdir, 'extract')
+            out = open(tmp_fn, 'wb')
+            out.write(MAGIC)
+            out.write(struct.pack('<I', len(header)))
+            out.write(header)
+            # the columns start at offset 12 + len(header); pad them to 8 bytes too
+            out.write('\0' * 4)
+            for (name, dtype) in COLUMNS:
+                f = open(os.path.join(self.tmpdir, name), 'rb')
+                shutil.copyfileobj(f, out)
+                f.close()
+            out.close()
+            os.rename(tmp_fn, self.fn)
+        except:
+            self.abort()
+            raise
+        shutil.rmtree(self.tmpdir)
+        logger.debug('wrote %d rows to %s', self.rows, self.fn)
+
+    def abort(self):
+        '''Closes and removes the temporary files, without writing the extract file'''
+        for f in self.column_files:
+            f.close()
+        shutil.rmtree(self.tmpdir, ignore_errors=True)
+        logger.debug('discarded the extract file %s', self.fn)
+
+
+def read_extract(fn):
+    '''Returns (header, columns) for the extract file `fn`, where `columns` is
+    a dict of read-only `numpy.memmap`s keyed by column name.
+    '''
+    if numpy is None:
+        raise ImportError('reading extract files requires numpy')
+    f = open(fn, 'rb')
+    if f.read(len(MAGIC)) != MAGIC:
+        raise ValueError('%s is not a geowiki extract file' % fn)
+    (header_len,) = struct.unpack('<I', f.read(4))
+    header = json.loads(f.read(header_len))
+    f.close()
+
+    offset = len(MAGIC) + 4 + header_len + 4
+    columns = {}
+    for (name, dtype) in header['columns']:
+        dtype = numpy.dtype(str(dtype)).newbyteorder('<')
+        if header['rows']:
+            columns[name] = numpy.memmap(fn, dtype=dtype, mode='r', offset=offset, shape=(header['rows'],))
+        else:
+            # empty files can not be mapped
+            columns[name] = numpy.zeros(0, dtype=dtype)
+        offset += dtype.itemsize * header['rows']
+    return header, columns
@@ -0,0 +1,191 @@
+'''
+
+Offline sources of checkuser data.
+
+Instead of querying a live replica, `process_data --source tsv|sqlite` reads
+`cu_changes` exports from `--source_path`:
+
+* tsv: gzipped (or plain) tab separated files named `<db_name>*.tsv.gz`,
+  e.g. `enwiki.cu_changes.201305.tsv.gz`. The first line holds the column
+  names (`cuc_user`, `cuc_ip`, `cuc_timestamp`, ...). Files are read by
+  `--read_threads` threads and parsed in chunks.
+* sqlite: a file `<db_name>.sqlite` with a `cu_changes` table.
+
+Rows are yielded as tuples with the columns of `mysql_config.get_cu_fields`
+for the `--dimensions` and are filtered like the range queries on the replica,
+including the user sample of `--sample`.
+Known bots are read from `<db_name>.bots` (one user id per line) or from a
+`user_groups` table in the sqlite file.
+
+'''
+
+import glob
+import gzip
+import logging
+import os
+import Queue
+import sqlite3
+
+from multiprocessing.pool import ThreadPool
+
+import mysql_config
+
+logger = logging.getLogger(__name__)
+
+# bytes read from a tsv file at a time
+CHUNK_SIZE = 1 << 22
+
+sqlite_query = "SELECT %s FROM cu_changes cuc WHERE %s AND cuc.cuc_timestamp>? AND cuc.cuc_timestamp<?"
+
+
+def get_tsv_files(wp_pr, opts):
+    db_name = mysql_config.get_db_name(wp_pr)
+    pattern = os.path.join(opts['source_path'], '%s*.tsv*' % db_name)
+    return sorted(fn for fn in glob.glob(pattern) if fn.endswith('.tsv') or fn.endswith('.tsv.gz'))
+
+
+def get_sqlite_file(wp_pr, opts):
+    return os.path.join(opts['source_path'], '%s.sqlite' % mysql_config.get_db_name(wp_pr))
+
+
+def open_tsv(fn):
+    return gzip.open(fn, 'rb') if fn.endswith('.gz') else open(fn, 'rb')
+
+
+def parse_chunk(lines, header, start_ts, end_ts, dimensions=(), sample=None):
+    '''Parses the tab separated `lines` and returns the rows that pass the
+    checkuser query's filters, as tuples with the columns of
+    `get_cu_fields(dimensions)`. With `sample`, only the rows of users whose
+    id is a multiple of `sample` are returned. Lines that do not have the
+    columns of `header` are skipped.
+    '''
+    idx = dict((column, i) for (i, column) in enumerate(header))
+    user_idx = idx['cuc_user']
+    ns_idx = idx.get('cuc_namespace') if 'namespace' not in dimensions else None
+    ts_idx = idx.get('cuc_timestamp')
+    int_columns = set(['cuc_user', 'cuc_id'] + [mysql_config.DIMENSIONS[dimension] for dimension in dimensions])
+    # (index in the line, whether to convert to int) of each field, with a
+    # None index for the columns missing from the export
+    selected = [(idx.get(field), field in int_columns) for field in mysql_config.get_cu_fields(dimensions)]
+
+    rows = []
+    skipped = 0
+    for line in lines:
+        values = line.rstrip('\r').split('\t')
+        if len(values) != len(header):
+            skipped += bool(line.strip())
+            continue
+        if ns_idx is not None and values[ns_idx] != '0':
+            continue
+        if ts_idx is not None and not start_ts < values[ts_idx] < end_ts:
+            continue
+        try:
+            user = int(values[user_idx])
+            if user == 0 or (sample and user % sample):
+                continue
+            rows.append(tuple(None if i is None else int(values[i]) if to_int else values[i]
+                              for (i, to_int) in selected))
+        except ValueError:
+            skipped += 1
+    if skipped:
+        logger.warning('skipped %d malformed lines', skipped)
+    return rows
+
+
+def read_tsv(fn, start_ts, end_ts, chunks, dimensions=(), sample=None):
+    '''Reads `fn` in chunks of `CHUNK_SIZE` bytes and puts the parsed rows of
+    each chunk on the queue `chunks`, followed by None. Errors are put on the
+    queue instead.
+    '''
+    try:
+        f = open_tsv(fn)
+        header = f.readline().rstrip('\r\n').split('\t')
+        rest = ''
+        while True:
+            data = f.read(CHUNK_SIZE)
+            if not data:
+                break
+            lines = (rest + data).split('\n')
+            rest = lines.pop()
+            chunks.put(parse_chunk(lines, header, start_ts, end_ts, dimensions, sample))
+        if rest:
+            chunks.put(parse_chunk([rest], header, start_ts, end_ts, dimensions, sample))
+        f.close()
+        chunks.put(None)
+    except Exception, e:
+        logger.exception('could not read %s', fn)
+        chunks.put(e)
+
+
+def tsv_resultset(wp_pr, start, end, opts):
+    fns = get_tsv_files(wp_pr, opts)
+    if not fns:
+        raise IOError('no tsv exports for %s in %s' % (wp_pr, opts['source_path']))
+    logger.debug('%s: reading %d tsv files from %s', wp_pr, len(fns), opts['source_path'])
+    start_ts = mysql_config.wiki_timestamp(start)
+    end_ts = mysql_config.wiki_timestamp(end)
+
+    chunks = Queue.Queue(maxsize=2 * opts['read_threads'])
+    pool = ThreadPool(opts['read_threads'])
+    for fn in fns:
+        pool.apply_async(read_tsv, (fn, start_ts, end_ts, chunks, opts['dimensions'], opts['sample']))
+    pool.close()
+
+    remaining = len(fns)
+    while remaining:
+        chunk = chunks.get()
+        if chunk is None:
+            remaining -= 1
+        elif isinstance(chunk, Exception):
+            pool.terminate()
+            raise chunk
+        else:
+            for row in chunk:
+                yield row
+    pool.join()
+
+
+def sqlite_resultset(wp_pr, start, end, opts):
+    fn = get_sqlite_file(wp_pr, opts)
+    if not os.path.exists(fn):
+        raise IOError('no sqlite export for %s: %s' % (wp_pr, fn))
+    logger.debug('%s: reading %s', wp_pr, fn)
+    db = sqlite3.connect(fn)
+    cur = db.cursor()
+    dimensions = opts['dimensions']
+    query = sqlite_query % (', '.join(mysql_config.get_cu_fields(dimensions)),
+                            mysql_config.get_cu_conditions(dimensions, opts['sample']))
+    cur.execute(query, (mysql_config.wiki_timestamp(start), mysql_config.wiki_timestamp(end)))
+    while True:
+        rows = cur.fetchmany(10000)
+        if not rows:
+            break
+        for row in rows:
+            yield row
+    db.close()
+
+
+def resultset(wp_pr, start, end, opts):
+    '''Returns an iterable over the checkuser rows of `wp_pr` between `start`
+    and `end`, read from the `opts['source']` export in `opts['source_path']`.
+    '''
+    if opts['source'] == 'tsv':
+        return tsv_resultset(wp_pr, start, end, opts)
+    elif opts['source'] == 'sqlite':
+        return sqlite_resultset(wp_pr, start, end, opts)
+    raise ValueError('unknown source: %s' % opts['source'])
+
+
+def retrieve_bot_ids(wp_pr, opts):
+    '''Returns the set of bot user ids exported for `wp_pr`, possibly empty'''
+    bots = set()
+    bot_fn = os.path.join(opts['source_path'], '%s.bots' % mysql_config.get_db_name(wp_pr))
+    if os.path.exists(bot_fn):
+        bots.update(long(b) for b in open(bot_fn, 'r') if b.strip())
+    if opts['source'] == 'sqlite' and os.path.exists(get_sqlite_file(wp_pr, opts)):
+        db = sqlite3.connect(get_sqlite_file(wp_pr, opts))
+        has_groups = db.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name='user_groups'").fetchone()
+        if has_groups:
+            bots.update(row[0] for row in db.execute("SELECT ug_user FROM user_groups WHERE ug_group='bot'"))
+        db.close()
+    return bots
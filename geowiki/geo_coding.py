@@ -16,6 +16,14 @@ from collections import defaultdict
 
 import GeoIP
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+import geocode_cache
+import spill
+
 logger = logging.getLogger(__name__)
 
 
@@ -23,8 +31,76 @@ def valid_ip(ip):
     return bool(re.match('[0-9]{1,3}\.[0-9]{1,3}\.[0-9]{1,3}\.[0-9]{1,3}', ip))
 
 
+def get_geoip_version(geoIP_db):
+    '''Returns the version string of the GeoIP database in `geoIP_db`, e.g.
+    `GEO-533LITE 20130702 Build 1 ...`. It identifies the database in caches
+    and ledgers that outlive a single run.
+    '''
+    gi = GeoIP.open(geoIP_db, GeoIP.GEOIP_STANDARD)
+    return gi.database_info
+
+
+def open_geoip(geoIP_db):
+    '''Returns a GeoIP handle for `geoIP_db` that returns UTF-8 encoded names.
+    The legacy default is ISO-8859-1, which the json sinks can not encode.
+    '''
+    gi = GeoIP.open(geoIP_db, GeoIP.GEOIP_MEMORY_CACHE)
+    gi.set_charset(GeoIP.GEOIP_CHARSET_UTF8)
+    return gi
+
+
+def geocode(gi, ip):
+    '''Returns the (country, city) pair for `ip` using the GeoIP handle `gi`.
+    Raises whatever the GeoIP lookup raises.
+    '''
+    record = gi.record_by_addr(ip)
+    if not record:
+        # ip invalid
+        return ('Invalid IP', 'Invalid IP')
+
+    city = record['city']
+    country = record['country_name']
+
+    # city and country are part of primary keys, so never None
+    if city is None or city == '' or city == ' ':
+        city = "Unknown"
+
+    if country is None or country == '' or country == ' ':
+        country = "Unknown"
+
+    return (country, city)
+
+
+def get_main_slice(dimensions):
+    '''Returns a function of a slice, the tuple of the values of `dimensions`
+    of a row, telling whether the row counts towards the main datasets, i.e.
+    is an edit to namespace 0. Returns None if all rows do.
+    '''
+    if 'namespace' not in dimensions:
+        return None
+    idx = list(dimensions).index('namespace')
+    return lambda slice_: slice_[idx] == 0
+
+
+def count_edit(editors, user, country):
+    '''Counts an edit of `user` from `country` in `editors`, a dict like the
+    one returned by `extract` or a `spill.SpillingEditors`
+    '''
+    if isinstance(editors, spill.SpillingEditors):
+        editors.add(user, country)
+        return
+    countries = editors.get(user)
+    if countries is None:
+        countries = editors[user] = {}
+    if country in countries:
+        countries[country]['edits'] += 1
+    else:
+        countries[country] = {'edits': 1}
+
+
 ### EXTRACT
-def extract(source, filter_ids, geoIP_db, sep=None):
+def extract(source, filter_ids, geoIP_db, sep=None, geo_cache=None, spill_threshold=None, spill_dir=None,
+            dimensions=0, main_slice=None):
     '''Extracts geo data on editor and country/city level from the data source.
 
     The source is a compressed mysql result set with the following format.
@@ -38,10 +114,14 @@ def extract(source, filter_ids, geoIP_db, sep=None):
     :arg filter_ids: set, containing user id that should be filtered, e.g. bots. Set can be empty in which case nothing will be filtered.
     :arg geoIP_db: str, path to Geo IP database
     :arg sep: str, separator for elements in source if they are strings. If None, elements won't be split
-    :returns: (editors,cities)
+    :arg geo_cache: `geocode_cache.GeocodeCache`, consulted before and updated after each GeoIP lookup. If None, every ip is resolved with GeoIP
+    :arg spill_threshold: int, approximate memory (in MB) above which editor counts, of all slices together, are spilled to sorted run files in `spill_dir`. If None, editors are kept in a dict
+    :arg dimensions: int, number of dimension columns (e.g. `cuc_namespace`, `cuc_type`) at the end of each row. Editors are also counted per slice, i.e. per tuple of the values of these columns, in the same pass
+    :arg main_slice: function of a slice returning whether its rows count towards `editors` and `cities`, see `get_main_slice`. If None, all rows do
+    :returns: (editors,cities), where editors is a `spill.SpillingEditors` if `spill_threshold` is set. With `dimensions`, (editors,cities,slices), where slices is {slice : editors}
     '''
     logger.debug('entering, geoIP_db: %s' % (geoIP_db))
-    gi = GeoIP.open(geoIP_db, GeoIP.GEOIP_MEMORY_CACHE)
+    gi = open_geoip(geoIP_db)
     logger.debug('loaded cache')
 
     # test
@@ -50,6 +130,11 @@ def extract(source, filter_ids, geoIP_db, sep=None):
 
     editors = {}
     cities = {}
+    if spill_threshold:
+        # the editors of all slices share the memory of spill_threshold
+        budget = spill.SpillBudget(spill_threshold * 1024 * 1024 / spill.ENTRY_SIZE)
+        editors = spill.SpillingEditors(budget, spill_dir)
+    slices = {}
 
     for line in source:
         # a line can be a tuple from a sql resultset or a '\n' escaped line in a text file
@@ -67,31 +152,36 @@ def extract(source, filter_ids, geoIP_db, sep=None):
         ip = res[1]
 
         # geo lookup
-        record = None
         if valid_ip(ip):
-            try:
-                record = gi.record_by_addr(ip)
-            except:
-                logger.exception('encountered exception while geocoding ip: %s', ip)
-                continue
+            location = geo_cache.get(ip) if geo_cache is not None else None
+            if location is None:
+                try:
+                    location = geocode(gi, ip)
+                except:
+                    logger.exception('encountered exception while geocoding ip: %s', ip)
+                    continue
+                if geo_cache is not None:
+                    geo_cache.put(ip, location)
+            (country, city) = location
         else:
             # ip invalid
             city = 'Invalid IP'
             country = 'Invalid IP'
 
-        if record:
-            city = record['city']
-            country = record['country_name']
-
-            if city == '' or city == ' ':
-                city = "Unknown"
-
-            if country == '' or country == ' ':
-                country = "Unknown"
-        else:
-            # ip invalid
-            city = 'Invalid IP'
-            country = 'Invalid IP'
+        # slice -> editors data
+
+        if dimensions:
+            slice_ = tuple(res[-dimensions:])
+            slice_editors = slices.get(slice_)
+            if slice_editors is None:
+                if spill_threshold:
+                    slice_editors = spill.SpillingEditors(budget, spill_dir)
+                else:
+                    slice_editors = {}
+                slices[slice_] = slice_editors
+            count_edit(slice_editors, user, country)
+            if main_slice is not None and not main_slice(slice_):
+                continue
 
         # country -> city data
 
@@ -105,6 +195,10 @@ def extract(source, filter_ids, geoIP_db, sep=None):
 
         # country -> editors data
 
+        if spill_threshold:
+            editors.add(user, country)
+            continue
+
         if user not in editors:
             editors[user] = {}
 
@@ -117,10 +211,81 @@ def extract(source, filter_ids, geoIP_db, sep=None):
             editors[user][country]['edits'] = 1
             # editors[user][country]['len_change'] = len_change
 
+    if dimensions:
+        return (editors, cities, slices)
     return (editors, cities)
 
 
-def get_active_editors(wp_pr, editors, opts):
+def extract_arrays(users, ips, filter_ids, geoIP_db, geo_cache=None):
+    '''Same as `extract`, for rows given as numpy arrays of user ids and
+    integer ips (0 for invalid ips), e.g. the columns of an extract file.
+    Each distinct ip is geocoded once and the counting is vectorized.
+
+    :returns: (editors,cities)
+    '''
+    gi = open_geoip(geoIP_db)
+
+    keep = numpy.ones(len(users), dtype=bool)
+    if filter_ids:
+        keep &= ~numpy.in1d(users, numpy.array(list(filter_ids), dtype=users.dtype))
+    users = users[keep]
+    (distinct_ips, ip_idx) = numpy.unique(ips[keep], return_inverse=True)
+
+    # geocode each distinct ip once
+    locations = []
+    location_ids = {}
+    ip_location = numpy.empty(len(distinct_ips), dtype=numpy.int64)
+    for (i, n) in enumerate(distinct_ips):
+        location = None
+        if n:
+            ip = geocode_cache.int_to_ip(int(n))
+            location = geo_cache.get(ip) if geo_cache is not None else None
+            if location is None:
+                try:
+                    location = geocode(gi, ip)
+                except:
+                    logger.exception('encountered exception while geocoding ip: %s', ip)
+                    ip_location[i] = -1
+                    continue
+                if geo_cache is not None:
+                    geo_cache.put(ip, location)
+        else:
+            # ip invalid
+            location = ('Invalid IP', 'Invalid IP')
+        if location not in location_ids:
+            location_ids[location] = len(locations)
+            locations.append(location)
+        ip_location[i] = location_ids[location]
+
+    row_location = ip_location[ip_idx]
+    geocoded = row_location >= 0
+    users = users[geocoded]
+    row_location = row_location[geocoded]
+
+    # country -> city data
+    cities = {}
+    for (location_id, count) in enumerate(numpy.bincount(row_location, minlength=len(locations))):
+        if count:
+            (country, city) = locations[location_id]
+            cities.setdefault(country, {})[city] = int(count)
+
+    # country -> editors data
+    countries = sorted(set(country for (country, city) in locations))
+    country_ids = dict((country, i) for (i, country) in enumerate(countries))
+    location_country = numpy.array([country_ids[country] for (country, city) in locations], dtype=numpy.uint64)
+    keys = (users.astype(numpy.uint64) << numpy.uint64(16)) | location_country[row_location]
+    (distinct_keys, counts) = numpy.unique(keys, return_counts=True)
+    editors = {}
+    for (key, count) in zip(distinct_keys.tolist(), counts.tolist()):
+        editors.setdefault(key >> 16, {})[countries[key & 0xffff]] = {'edits': count}
+
+    return (editors, cities)
+
+
+def tally_active_editors(editors):
+    '''Returns (country_nest, world_nest), the number of editors per
+    {country : {cohort : count}} and {cohort : count}.
+    '''
     ### Editor activity
 
     bins = map(str, range(1, 11))
@@ -148,71 +313,140 @@ def get_active_editors(wp_pr, editors, opts):
                 bottom = 10 * (int(count) / 10)
                 country_nest[country]['%s-%s' % (bottom, bottom + 10)] += 1
 
-    # flatten
-    country_rows = []
+    return country_nest, world_nest
+
+
+def get_window_days(opts):
+    '''Returns the length in days of the window `opts['start']` to `opts['end']`'''
+    return (opts['end'] - opts['start']).days
+
+
+# The row generators below yield tuples with the columns of the corresponding
+# `mysql_config.DEST_TABLES` entry, in order and without `ts`.
+
+def country_active_editor_rows(wp_pr, country_nest, opts):
+    '''Yields (project, country, cohort, start, end, window_days, count) rows'''
     start_str = opts['start'].isoformat()
     end_str = opts['end'].isoformat()
-    for country, cohorts in country_nest.items():
-        for cohort, count in cohorts.items():
-            row = {
-                'project': wp_pr,
-                'country': country,
-                'cohort': cohort,
-                'start': start_str,
-                'end': end_str,
-                'count': count,
-            }
-            country_rows.append(row)
-
-    world_rows = []
-    for cohort, count in world_nest.items():
-        row = {
-            'project': wp_pr,
-            'cohort': cohort,
-            'start': start_str,
-            'end': end_str,
-            'count': count,
-        }
-        world_rows.append(row)
-
-    return country_rows, world_rows
+    window_days = get_window_days(opts)
+    for country, cohorts in country_nest.iteritems():
+        for cohort, count in cohorts.iteritems():
+            yield (wp_pr, country, cohort, start_str, end_str, window_days, count)
 
 
-def get_city_edits(wp_pr, countries, opts):
+def world_active_editor_rows(wp_pr, world_nest, opts):
+    '''Yields (project, cohort, start, end, window_days, count) rows'''
+    start_str = opts['start'].isoformat()
+    end_str = opts['end'].isoformat()
+    window_days = get_window_days(opts)
+    for cohort, count in world_nest.iteritems():
+        yield (wp_pr, cohort, start_str, end_str, window_days, count)
+
+
+def get_active_editors(wp_pr, editors, opts):
+    '''Returns generators over the country and world active editor rows'''
+    country_nest, world_nest = tally_active_editors(editors)
+    return (country_active_editor_rows(wp_pr, country_nest, opts),
+            world_active_editor_rows(wp_pr, world_nest, opts))
+
+
+def project_rollup_rows(wp_pr, country_nest, opts):
+    '''Yields (project, cohort, start, end, window_days, count) rows summed over all countries'''
+    start_str = opts['start'].isoformat()
+    end_str = opts['end'].isoformat()
+    window_days = get_window_days(opts)
+    totals = defaultdict(int)
+    for cohorts in country_nest.itervalues():
+        for cohort, count in cohorts.iteritems():
+            totals[cohort] += count
+    for cohort, count in totals.iteritems():
+        yield (wp_pr, cohort, start_str, end_str, window_days, count)
+
+
+def top_country_rollup_rows(wp_pr, country_nest, opts):
+    '''Yields (project, country, cohort, start, end, window_days, country_rank, count)
+    rows for the `opts['rollup_top_k']` countries with the most editors
+    '''
+    start_str = opts['start'].isoformat()
+    end_str = opts['end'].isoformat()
+    window_days = get_window_days(opts)
+    ranked = sorted(country_nest, key=lambda country: (-country_nest[country]['all'], country))
+    for rank, country in enumerate(ranked[:opts['rollup_top_k']], 1):
+        for cohort, count in country_nest[country].iteritems():
+            yield (wp_pr, country, cohort, start_str, end_str, window_days, rank, count)
+
+
+def group_rollup_rows(wp_pr, country_nest, opts):
+    '''Yields (project, group_set, group_name, cohort, start, end, window_days, count)
+    rows summed over the countries of each group in `opts['country_groups']`,
+    a {grouping : {country : group_name}} dict. Countries missing from a
+    grouping are left out of it.
+    '''
+    start_str = opts['start'].isoformat()
+    end_str = opts['end'].isoformat()
+    window_days = get_window_days(opts)
+    for grouping, country_group in sorted((opts.get('country_groups') or {}).iteritems()):
+        totals = defaultdict(int)
+        for country, cohorts in country_nest.iteritems():
+            group_name = country_group.get(country)
+            if group_name is None:
+                continue
+            for cohort, count in cohorts.iteritems():
+                totals[(group_name, cohort)] += count
+        for (group_name, cohort), count in totals.iteritems():
+            yield (wp_pr, grouping, group_name, cohort, start_str, end_str, window_days, count)
+
+
+def breakdown_rows(wp_pr, slice_nests, opts):
+    '''Yields (project, dimensions, slice, country, cohort, start, end, window_days, count)
+    rows for the {slice : country_nest} of the `opts['dimensions']` breakdown
+    '''
+    start_str = opts['start'].isoformat()
+    end_str = opts['end'].isoformat()
+    window_days = get_window_days(opts)
+    dimensions = ','.join(opts['dimensions'])
+    for slice_, country_nest in slice_nests.iteritems():
+        slice_str = ','.join('' if v is None else str(v) for v in slice_)
+        for country, cohorts in country_nest.iteritems():
+            for cohort, count in cohorts.iteritems():
+                yield (wp_pr, dimensions, slice_str, country, cohort, start_str, end_str, window_days, count)
+
+
+def country_total_edit_rows(wp_pr, countries, opts):
+    '''Yields (project, country, start, end, window_days, edits) rows'''
+    start_str = opts['start'].isoformat()
+    end_str = opts['end'].isoformat()
+    window_days = get_window_days(opts)
+    for country, cities in countries.iteritems():
+        yield (wp_pr, country, start_str, end_str, window_days, sum(cities.itervalues()))
+
+
+def city_fraction_rows(wp_pr, countries, opts):
+    '''Yields (project, country, city, start, end, window_days, fraction) rows for the
+    cities with at least 10% of the edits of their country
+    '''
     ### City rankings
 
-    city_rows = []
-    country_totals = []
     start_str = opts['start'].isoformat()
     end_str = opts['end'].isoformat()
+    window_days = get_window_days(opts)
     for country, cities in countries.iteritems():
 
         city_info_sorted = sorted(cities.iteritems(), key=operator.itemgetter(1), reverse=True)
         totaledits = sum([c[1] for c in city_info_sorted])
-        row = {
-            'project': wp_pr,
-            'country': country,
-            'start': start_str,
-            'end': end_str,
-            'edits': totaledits,
-        }
-        country_totals.append(row)
 
         ### pseudo-confuscation for 1 to 10 scale
         #city_info_sorted_aggr = [ (c[0] , (10.*c[1]/city_info_sorted[0][1])) for c in city_info_sorted[:opts['top_cities']]]
 
         # normalization
-        city_info_normalized = [(name, edits / float(totaledits)) for (name, edits) in city_info_sorted]
-        city_info_min_fraction = filter(lambda (name, frac): frac >= 0.1, city_info_normalized)
-        for city, frac in city_info_min_fraction:
-            row = {
-                'project': wp_pr,
-                'country': country,
-                'city': city,
-                'start': start_str,
-                'end': end_str,
-                'fraction': frac,
-            }
-            city_rows.append(row)
-
-    return city_rows, country_totals
+        for (city, edits) in city_info_sorted:
+            frac = edits / float(totaledits)
+            if frac < 0.1:
+                break
+            yield (wp_pr, country, city, start_str, end_str, window_days, frac)
+
+
+def get_city_edits(wp_pr, countries, opts):
+    '''Returns generators over the city fraction and country total edit rows'''
+    return (city_fraction_rows(wp_pr, countries, opts),
+            country_total_edit_rows(wp_pr, countries, opts))
@@ -0,0 +1,146 @@
+'''
+
+Run-level cache of geocoded IP addresses.
+
+The same IP addresses show up on many projects (commons-heavy users, editors
+of several languages, shared ISP ranges) and on every day of a `--daily` run.
+The cache is a SQLite file shared by all worker processes of a run. Entries
+are keyed by the integer IP address and the version string of the GeoIP
+database that resolved them, so upgrading the GeoIP database never serves
+stale locations.
+
+'''
+
+import logging
+import socket
+import sqlite3
+import struct
+
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+cache_table = """CREATE TABLE IF NOT EXISTS geocode (
+    geoip_version TEXT NOT NULL,
+    ip INTEGER NOT NULL,
+    country TEXT,
+    city TEXT,
+    PRIMARY KEY (geoip_version, ip))"""
+
+
+def ip_to_int(ip):
+    '''Returns the integer representation of the dotted-quad `ip`, or None if
+    `ip` can not be parsed.
+    '''
+    try:
+        return struct.unpack('!I', socket.inet_aton(ip))[0]
+    except (socket.error, TypeError):
+        return None
+
+
+def int_to_ip(n):
+    '''Returns the dotted-quad representation of the integer ip `n`'''
+    return socket.inet_ntoa(struct.pack('!I', n))
+
+
+def connect(cache_fn):
+    '''Returns a connection to the cache in `cache_fn`. The connection waits
+    for concurrent writers instead of failing right away.
+    '''
+    db = sqlite3.connect(cache_fn, timeout=60)
+    # names are stored as the UTF-8 encoded byte strings GeoIP returns
+    db.text_factory = str
+    return db
+
+
+def init_cache(cache_fn):
+    '''Creates the cache table in `cache_fn`. Call once per run, before the
+    worker processes are started.
+    '''
+    db = connect(cache_fn)
+    db.execute('PRAGMA journal_mode=WAL')
+    db.execute(cache_table)
+    db.commit()
+    db.close()
+
+
+class GeocodeCache(object):
+    '''Per-process handle on the shared geocode cache.
+
+    Lookups first hit an in-process LRU dict of the `local_size` most recently
+    used entries, then the SQLite file. New entries are buffered and written
+    in batches of `flush_size`, so workers do not contend for the write lock
+    on every miss.
+
+    :arg cache_fn: str, path to the SQLite file created by `init_cache`
+    :arg geoip_version: str, version of the GeoIP database used for lookups
+    :arg flush_size: int, number of new entries buffered before writing
+    :arg local_size: int, number of entries kept in memory
+    '''
+
+    def __init__(self, cache_fn, geoip_version, flush_size=10000, local_size=200000):
+        self.db = connect(cache_fn)
+        # entries cached before lookups returned UTF-8 hold ISO-8859-1 names
+        self.geoip_version = '%s (utf-8)' % geoip_version
+        self.flush_size = flush_size
+        self.local_size = local_size
+        self.local = OrderedDict()
+        self.pending = []
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, ip):
+        '''Returns the cached (country, city) pair for `ip` or None'''
+        key = ip_to_int(ip)
+        if key is None:
+            return None
+        location = self.local.pop(key, None)
+        if location is None:
+            row = self.db.execute(
+                'SELECT country, city FROM geocode WHERE geoip_version=? AND ip=?',
+                (self.geoip_version, key)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            location = tuple(row)
+        self.remember(key, location)
+        self.hits += 1
+        return location
+
+    def remember(self, key, location):
+        '''Keeps `location` in memory as the most recently used entry,
+        dropping the least recently used one if there are too many
+        '''
+        self.local[key] = location
+        if len(self.local) > self.local_size:
+            self.local.popitem(last=False)
+
+    def put(self, ip, location):
+        '''Stores the (country, city) pair `location` for `ip`'''
+        key = ip_to_int(ip)
+        if key is None:
+            return
+        self.remember(key, location)
+        self.pending.append((self.geoip_version, key) + tuple(location))
+        if len(self.pending) >= self.flush_size:
+            self.flush()
+
+    def flush(self):
+        '''Writes buffered entries to the shared file. If another process
+        holds the write lock for too long, the entries are kept for the next
+        flush.
+        '''
+        if not self.pending:
+            return
+        try:
+            self.db.executemany('INSERT OR IGNORE INTO geocode VALUES (?, ?, ?, ?)', self.pending)
+            self.db.commit()
+            self.pending = []
+        except sqlite3.OperationalError:
+            logger.warning('could not write %d entries to geocode cache, will retry', len(self.pending))
+            self.db.rollback()
+
+    def close(self):
+        self.flush()
+        self.db.close()
+        logger.debug('geocode cache hits: %d, misses: %d', self.hits, self.misses)
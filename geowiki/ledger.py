@@ -0,0 +1,171 @@
+'''
+
+Checkpoint ledger of the (project, start, end, GeoIP version, settings) units
+of work, where the settings are a hash of the options that change what is
+written for a unit.
+
+The ledger is a SQLite file, by default in the output directory. Every unit
+is claimed before it is processed and marked as done (with the number of rows
+written per dataset) or failed afterwards. This lets `--resume` skip units
+that already finished, and keeps overlapping invocations, e.g. a daily cron
+run and a manual backfill, from processing the same unit at the same time.
+Claims of processes on other hosts can not be checked, and are considered
+abandoned after `--stale_claim` hours.
+
+'''
+
+import hashlib
+import json
+import logging
+import os
+import socket
+import sqlite3
+import time
+
+import mysql_config
+
+logger = logging.getLogger(__name__)
+
+LEDGER_FN = 'geowiki_ledger.sqlite'
+
+# options of process_data that change what is written for a unit, along with
+# the destination table names of `mysql_config.DEST_TABLES`
+OUTPUT_OPTIONS = ['dimensions', 'sample', 'top_cities', 'rollup_top_k', 'country_groups',
+                  'skip_mysql', 'dest_db_name', 'write_files', 'file_format', 'file_compression',
+                  'write_extract', 'output_dir', 'basename', 'limn_basedir_private', 'limn_basedir_public']
+
+ledger_table = """CREATE TABLE IF NOT EXISTS units (
+    project TEXT NOT NULL,
+    start TEXT NOT NULL,
+    end TEXT NOT NULL,
+    geoip_version TEXT NOT NULL,
+    settings TEXT NOT NULL DEFAULT '',
+    status TEXT NOT NULL,
+    host TEXT,
+    pid INTEGER,
+    started REAL,
+    finished REAL,
+    row_counts TEXT,
+    peak_rss INTEGER,
+    PRIMARY KEY (project, start, end, geoip_version, settings))"""
+
+
+def get_ledger_fn(opts):
+    return opts['ledger'] or os.path.join(opts['output_dir'], LEDGER_FN)
+
+
+def connect(ledger_fn):
+    # autocommit mode, transactions are started explicitly
+    return sqlite3.connect(ledger_fn, timeout=60, isolation_level=None)
+
+
+def init_ledger(ledger_fn):
+    '''Creates the ledger table in `ledger_fn` if it does not exist yet'''
+    db = connect(ledger_fn)
+    db.execute(ledger_table)
+    # ledgers written before peak_rss was recorded
+    columns = [row[1] for row in db.execute('PRAGMA table_info(units)')]
+    if 'peak_rss' not in columns:
+        db.execute('ALTER TABLE units ADD COLUMN peak_rss INTEGER')
+        columns.append('peak_rss')
+    # ledgers written before the settings were part of the key, whose units
+    # get empty settings and are thus processed again
+    if 'settings' not in columns:
+        db.execute('BEGIN IMMEDIATE')
+        db.execute('ALTER TABLE units RENAME TO units_unsettled')
+        db.execute(ledger_table)
+        db.execute('INSERT INTO units (%s) SELECT %s FROM units_unsettled' % (', '.join(columns), ', '.join(columns)))
+        db.execute('DROP TABLE units_unsettled')
+        db.execute('COMMIT')
+    db.close()
+
+
+def get_settings(opts):
+    '''Returns a hash of the options of `opts` that change what is written'''
+    options = OUTPUT_OPTIONS + sorted(mysql_config.DEST_TABLES)
+    settings = json.dumps(dict((option, opts.get(option)) for option in options), sort_keys=True, default=str)
+    return hashlib.sha1(settings).hexdigest()[:16]
+
+
+def get_unit(wp_pr, opts):
+    '''Returns the key of the unit of work processing `wp_pr` with `opts`'''
+    return (wp_pr, opts['start'].isoformat(), opts['end'].isoformat(), opts['geoip_version'], get_settings(opts))
+
+
+def owner_alive(host, pid, started, stale_after=None):
+    '''Returns False only if the claiming process is known to be gone. Claims
+    made on other hosts can not be checked, and are assumed to be alive until
+    they are older than `stale_after` seconds.
+    '''
+    if host != socket.gethostname() or pid is None:
+        return stale_after is None or started is None or time.time() - started < stale_after
+    try:
+        os.kill(pid, 0)
+    except OSError, e:
+        return e.errno != 3  # ESRCH
+    return True
+
+
+def claim(ledger_fn, unit, resume, stale_after=None):
+    '''Marks `unit` as running in this process and returns True, or returns
+    False if the unit should not be processed: it is done and `resume` is set,
+    or it is being processed by another live process, see `owner_alive` for
+    `stale_after`.
+    '''
+    db = connect(ledger_fn)
+    try:
+        db.execute('BEGIN IMMEDIATE')
+        row = db.execute(
+            'SELECT status, host, pid, started FROM units WHERE project=? AND start=? AND end=? AND geoip_version=? AND settings=?',
+            unit).fetchone()
+        if row is not None:
+            (status, host, pid, started) = row
+            if status == 'done' and resume:
+                db.execute('ROLLBACK')
+                logger.info('%s: already done for %s - %s, skipping', *unit[:3])
+                return False
+            if status == 'running' and owner_alive(host, pid, started, stale_after):
+                db.execute('ROLLBACK')
+                logger.warning('%s: %s - %s is being processed by pid %s on %s, skipping', unit[0], unit[1], unit[2], pid, host)
+                return False
+        db.execute(
+            'INSERT OR REPLACE INTO units (project, start, end, geoip_version, settings, status, host, pid, started) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+            unit + ('running', socket.gethostname(), os.getpid(), time.time()))
+        db.execute('COMMIT')
+        return True
+    finally:
+        db.close()
+
+
+def finish(ledger_fn, unit, status, row_counts=None, peak_rss=None):
+    '''Records the final `status` of `unit`, the number of rows written for
+    each dataset and the peak resident set size (in KB) of the process.
+    '''
+    db = connect(ledger_fn)
+    try:
+        db.execute(
+            'UPDATE units SET status=?, finished=?, row_counts=?, peak_rss=? '
+            'WHERE project=? AND start=? AND end=? AND geoip_version=? AND settings=?',
+            (status, time.time(), json.dumps(row_counts), peak_rss) + unit)
+    finally:
+        db.close()
+
+
+def get_peak_rss(ledger_fn):
+    '''Returns {project : peak_rss} with the peak resident set size (in KB)
+    of the most recent done unit of each project, or of a unit that failed
+    after it if that used more, e.g. one that was killed for running out of
+    memory.
+    '''
+    db = connect(ledger_fn)
+    try:
+        rows = db.execute(
+            "SELECT project, status, peak_rss FROM units "
+            "WHERE status IN ('done', 'failed') AND peak_rss IS NOT NULL ORDER BY finished")
+        peaks = {}
+        for (project, status, rss) in rows:
+            peaks[project] = rss if status == 'done' else max(rss, peaks.get(project, 0))
+        return peaks
+    finally:
+        db.close()
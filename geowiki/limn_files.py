@@ -0,0 +1,144 @@
+'''
+
+Direct updates of the per project Limn datafiles of
+`scripts/make_limn_files.py`.
+
+With `--limn_basedir_private` and `--limn_basedir_public`, `process_data.py`
+puts the window it just computed straight into the existing datafiles of the
+project, instead of `make_limn_files.py` querying the rows back from the
+destination database:
+
+* `<project>_all` (private), editors by country and cohort,
+* `<project>_top<k>` (private), for the countries already in the datafile
+  only, as the top k countries depend on the full history, and
+* `<project>wiki_editor_counts` (public), editors summed over all countries.
+
+Only datafiles that already exist are updated, and only for 30 day windows,
+the windows plotted by `make_limn_files.py`. Creating new datafiles and
+picking new top k countries is left to `make_limn_files.py`, which can then
+be run with `--skip_projects` to only write the cross-project datasources.
+Datafiles are written to a temporary file and renamed into place, and the
+column labels of the datasource are extended when new columns appear.
+
+'''
+
+import csv
+import glob
+import json
+import logging
+import os
+import tempfile
+
+import geo_coding as gc
+import mysql_config
+
+logger = logging.getLogger(__name__)
+
+LIMN_COHORTS = ['all', '5+', '100+']
+LIMN_WINDOW_DAYS = 30
+
+
+def get_datafile_fn(limn_id, basedir):
+    return os.path.join(basedir, 'datafiles', '%s.csv' % limn_id)
+
+
+def get_datasource_fn(limn_id, basedir):
+    return os.path.join(basedir, 'datasources', '%s.json' % limn_id)
+
+
+def csv_value(v):
+    if isinstance(v, unicode):
+        return v.encode('utf-8')
+    return str(v)
+
+
+def update_datasource(limn_id, basedir, old_columns, columns):
+    '''Replaces the labels of `old_columns` in the datasource of `limn_id` by
+    those of `columns`, keeping the labels before them (i.e. the date)
+    '''
+    fn = get_datasource_fn(limn_id, basedir)
+    if not os.path.exists(fn):
+        return
+    source = json.load(open(fn))
+    offset = len(source['columns']['labels']) - len(old_columns)
+    old_types = dict(zip(source['columns']['labels'][offset:], source['columns'].get('types', [])[offset:]))
+    source['columns']['labels'] = source['columns']['labels'][:offset] + columns
+    if 'types' in source['columns']:
+        source['columns']['types'] = source['columns']['types'][:offset] + [old_types.get(column, 'int') for column in columns]
+    (fd, tmp_fn) = tempfile.mkstemp(dir=os.path.dirname(fn), prefix='.%s.' % os.path.basename(fn))
+    with os.fdopen(fd, 'w') as f:
+        json.dump(source, f, indent=2)
+    os.chmod(tmp_fn, 0o644)
+    os.rename(tmp_fn, fn)
+
+
+def update_datafile(limn_id, basedir, date, values, new_columns=True):
+    '''Sets the row of `date` in the datafile of `limn_id` to `values`, a
+    {column label : value} dict, replacing the row of an earlier run for the
+    same date. Without `new_columns`, values of columns that are not yet in the
+    datafile are dropped. Returns False if there is no datafile to update.
+    '''
+    fn = get_datafile_fn(limn_id, basedir)
+    if not os.path.exists(fn):
+        logger.debug('no datafile %s to update, leaving it to make_limn_files.py', fn)
+        return False
+    with open(fn, 'rb') as f:
+        reader = csv.reader(f)
+        header = next(reader)
+        rows = [row for row in reader if row]
+    old_columns = header[1:]
+    columns = old_columns
+    if new_columns and set(values) - set(old_columns):
+        columns = sorted(set(old_columns) | set(values))
+
+    # keep the date format the datafile was written with
+    date_str = date.strftime('%Y/%m/%d' if rows and '/' in rows[-1][0] else '%Y-%m-%d')
+    by_date = dict((row[0], dict(zip(old_columns, row[1:]))) for row in rows)
+    by_date[date_str] = dict((column, csv_value(value)) for (column, value) in values.iteritems())
+
+    (fd, tmp_fn) = tempfile.mkstemp(dir=os.path.dirname(fn), prefix='.%s.' % os.path.basename(fn))
+    with os.fdopen(fd, 'wb') as f:
+        writer = csv.writer(f)
+        writer.writerow(header[:1] + columns)
+        for row_date in sorted(by_date):
+            writer.writerow([row_date] + [by_date[row_date].get(column, '') for column in columns])
+    os.chmod(tmp_fn, 0o644)
+    os.rename(tmp_fn, fn)
+    if columns != old_columns:
+        update_datasource(limn_id, basedir, old_columns, columns)
+    logger.debug('updated %s for %s', fn, date_str)
+    return True
+
+
+def get_rows(table_id, datasets):
+    '''Yields the rows of `table_id` in `datasets` as dicts'''
+    fields = mysql_config.get_fields(table_id)
+    for row in datasets[table_id]():
+        yield dict(zip(fields, row))
+
+
+def update_project(wp_pr, datasets, opts):
+    '''
+    Updates the Limn datafiles of `wp_pr` in `opts['limn_basedir_private']`
+    and `opts['limn_basedir_public']` with the window `opts['start']` to
+    `opts['end']`, from the `datasets` of `process_data.get_datasets`
+    '''
+    if gc.get_window_days(opts) != LIMN_WINDOW_DAYS:
+        logger.debug('not updating the limn datafiles of %s, the window is not %d days', wp_pr, LIMN_WINDOW_DAYS)
+        return
+
+    if opts['limn_basedir_private']:
+        by_country = dict(('%s (%s)' % (row['country'], row['cohort']), row['count'])
+                          for row in get_rows('active_editors_country', datasets)
+                          if row['cohort'] in LIMN_COHORTS and row['country'] is not None)
+        update_datafile(wp_pr + '_all', opts['limn_basedir_private'], opts['end'], by_country)
+        for fn in glob.glob(get_datafile_fn(wp_pr + '_top*', opts['limn_basedir_private'])):
+            limn_id = os.path.basename(fn)[:-len('.csv')]
+            if limn_id[len(wp_pr + '_top'):].isdigit():
+                update_datafile(limn_id, opts['limn_basedir_private'], opts['end'], by_country, new_columns=False)
+
+    if opts['limn_basedir_public']:
+        summed = dict(('%swiki (%s)' % (wp_pr, row['cohort']), row['count'])
+                      for row in get_rows('rollup_project', datasets)
+                      if row['cohort'] in LIMN_COHORTS)
+        update_datafile(wp_pr + 'wiki_editor_counts', opts['limn_basedir_public'], opts['end'], summed)
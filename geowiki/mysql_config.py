@@ -13,8 +13,7 @@ import os
 
 from datetime import datetime
 from collections import OrderedDict
-import codecs
-import json
+import itertools
 
 try:
     import MySQLdb
@@ -46,50 +45,87 @@ def construct_rc_query(wp_pr):
     '''
     return recentchanges_query % get_db_name(wp_pr)
 
-# mysql query for the check user data
-#checkuser_query = "SELECT cuc.cuc_user, cuc.cuc_ip FROM %s.cu_changes cuc WHERE cuc.cuc_namespace=0 AND cuc.cuc_user!=0 AND cuc.cuc_timestamp>=%s AND cuc.cuc_timestamp<%s"
-checkuser_query = "SELECT cuc.cuc_user, cuc.cuc_ip FROM %s.cu_changes cuc WHERE cuc.cuc_namespace=0 AND cuc.cuc_user!=0 AND cuc.cuc_timestamp>'%s' AND cuc.cuc_timestamp<'%s'"
+# columns selected by the range queries, in the order they appear in each row
+CU_FIELDS = ['cuc_user', 'cuc_ip', 'cuc_id', 'cuc_timestamp']
 
+# dimensions editors can additionally be counted by with `--dimensions`, as
+# {dimension : cu_changes column}. The columns of the selected dimensions are
+# read after `CU_FIELDS` in the same scan.
+DIMENSIONS = OrderedDict([
+    ('namespace', 'cuc_namespace'),
+    ('type', 'cuc_type'),
+])
 
-def construct_cu_query(wp_pr, start, end):
-    '''Constructs a query for the checkuser table for a given month. The timestamp `ts` can be either:
-        * `201205`, data for the month of May 2012
-        * `20120525`, the last 30 days from the day passed.
-        * None, last 30 days from now()
+# bounds of cuc_id within a time window, used to split the scan into ranges
+checkuser_id_bounds_query = "SELECT MIN(cuc.cuc_id), MAX(cuc.cuc_id) FROM %s.cu_changes cuc WHERE cuc.cuc_timestamp>'%s' AND cuc.cuc_timestamp<'%s'"
 
-    Note:
-        The checkuser `cu_changes` table contains data for the last three month only!
+# one page of a keyset-paginated read of the cuc_id range (after, upto]
+checkuser_range_query = "SELECT %s FROM %s.cu_changes cuc WHERE %s AND cuc.cuc_timestamp>'%s' AND cuc.cuc_timestamp<'%s' AND cuc.cuc_id>%d AND cuc.cuc_id<=%d ORDER BY cuc.cuc_id LIMIT %d"
 
-    :arg ts: str, timestamp '201205'. If None, last 30 days will be used.
-    '''
-    def wiki_timestamp(dt):
-        return datetime.strftime(dt, '%Y%m%d%H%M%S')
-
-    # if ts:
-    #   if len(ts)==6:
-    #       y = int(ts[:4])
-    #       m = int(ts[4:])
-    #       start = datetime(y, m, 1)
-    #       end = datetime(y, m, calendar.monthrange(y,m)[1], 23, 59, 59)
-    #   if len(ts)==8:
-    #       y = int(ts[:4])
-    #       m = int(ts[4:6])
-    #       d = int(ts[6:8])
-    #       thirty = timedelta(days=30)
-    #       end = datetime(y, m, d, 23, 59, 59)
-    #       start = end-thirty
-    # else:
-    #   thirty = timedelta(days=30)
-    #   end = datetime.now()
-    #   start = end-thirty
-
-    return checkuser_query % (
+
+def wiki_timestamp(dt):
+    return datetime.strftime(dt, '%Y%m%d%H%M%S')
+
+
+def construct_cu_id_bounds_query(wp_pr, start, end):
+    '''Constructs a query for the smallest and largest `cuc_id` between `start` and `end`'''
+    return checkuser_id_bounds_query % (
         get_db_name(wp_pr),
         wiki_timestamp(start),
         wiki_timestamp(end)
     )
 
 
+def get_cu_fields(dimensions=()):
+    '''Returns the columns read from `cu_changes`: `CU_FIELDS`, followed by
+    the columns of `dimensions`
+    '''
+    return CU_FIELDS + [DIMENSIONS[dimension] for dimension in dimensions]
+
+
+def get_cu_conditions(dimensions=(), sample=None):
+    '''Returns the conditions on the `cu_changes` rows read. Only edits to
+    namespace 0 are read, unless namespace is one of `dimensions`. With
+    `sample`, only the edits of users whose id is a multiple of `sample` are.
+    '''
+    conditions = ['cuc.cuc_user!=0']
+    if 'namespace' not in dimensions:
+        conditions.insert(0, 'cuc.cuc_namespace=0')
+    if sample:
+        conditions.append('cuc.cuc_user %% %d = 0' % sample)
+    return ' AND '.join(conditions)
+
+
+def construct_cu_range_query(wp_pr, start, end, after, upto, limit, dimensions=(), sample=None):
+    '''Constructs a query for the next page of at most `limit` checkuser rows
+    with `after < cuc_id <= upto`, ordered by `cuc_id`. The next page starts
+    after the `cuc_id` of the last row returned. The columns of `dimensions`
+    are selected after `CU_FIELDS`, see `get_cu_conditions` for `sample`.
+    '''
+    return checkuser_range_query % (
+        ', '.join('cuc.%s' % f for f in get_cu_fields(dimensions)),
+        get_db_name(wp_pr),
+        get_cu_conditions(dimensions, sample),
+        wiki_timestamp(start),
+        wiki_timestamp(end),
+        after,
+        upto,
+        limit
+    )
+
+
+# MySQL errors worth retrying: refused or lost connections, queries killed by
+# the replica's query killer, lock wait timeouts and deadlocks
+TRANSIENT_ERROR_CODES = set([1040, 1053, 1205, 1213, 1317, 2003, 2006, 2013])
+
+
+def is_transient_error(e):
+    '''Returns True if the exception `e` is a MySQL error that is likely to go away on retry'''
+    if 'MySQLdb' not in globals():
+        return False
+    return isinstance(e, MySQLdb.OperationalError) and bool(e.args) and e.args[0] in TRANSIENT_ERROR_CODES
+
+
 # wikimedia cluster information extracted from:
 # http://noc.wikimedia.org/conf/highlight.php?file=db.php
 # NOTE: The default mapping is 's3'
@@ -187,7 +223,11 @@ DEST_TABLE_NAMES = {
     'active_editors_country': 'erosen_geocode_active_editors_country',
     'active_editors_world': 'erosen_geocode_active_editors_world',
     'city_edit_fraction': 'erosen_geocode_city_edit_fraction',
-    'country_total_edit': 'erosen_geocode_country_edits'
+    'country_total_edit': 'erosen_geocode_country_edits',
+    'rollup_project': 'erosen_geocode_rollup_project',
+    'rollup_top_countries': 'erosen_geocode_rollup_top_countries',
+    'rollup_group': 'erosen_geocode_rollup_group',
+    'active_editors_breakdown': 'erosen_geocode_active_editors_breakdown',
 }
 
 DEST_TABLES = {}
@@ -197,6 +237,7 @@ DEST_TABLES['active_editors_country'] = OrderedDict([
     ('cohort', 'VARCHAR(255)'),
     ('start', 'DATE'),
     ('end', 'DATE'),
+    ('window_days', 'INT'),
     ('count', 'INT'),
     ('ts', 'TIMESTAMP')])
 
@@ -205,6 +246,7 @@ DEST_TABLES['active_editors_world'] = OrderedDict([
     ('cohort', 'VARCHAR(255)'),
     ('start', 'DATE'),
     ('end', 'DATE'),
+    ('window_days', 'INT'),
     ('count', 'INT'),
     ('ts', 'TIMESTAMP')])
 
@@ -214,6 +256,7 @@ DEST_TABLES['city_edit_fraction'] = OrderedDict([
     ('city', 'VARCHAR(255)'),
     ('start', 'DATE'),
     ('end', 'DATE'),
+    ('window_days', 'INT'),
     ('fraction', 'FLOAT'),
     ('ts', 'TIMESTAMP')])
 
@@ -222,17 +265,162 @@ DEST_TABLES['country_total_edit'] = OrderedDict([
     ('country', 'VARCHAR(255)'),
     ('start', 'DATE'),
     ('end', 'DATE'),
+    ('window_days', 'INT'),
     ('edits', 'INT'),
     ('ts', 'TIMESTAMP')])
 
+# Rollups of active_editors_country, written alongside it so that Limn
+# generation reads small pre-aggregated tables. Summing over countries counts
+# an editor once per country, like the queries of make_limn_files did.
+
+# per project sums over all countries
+DEST_TABLES['rollup_project'] = OrderedDict([
+    ('project', 'VARCHAR(255)'),
+    ('cohort', 'VARCHAR(255)'),
+    ('start', 'DATE'),
+    ('end', 'DATE'),
+    ('window_days', 'INT'),
+    ('count', 'INT'),
+    ('ts', 'TIMESTAMP')])
+
+# all cohorts of the `--rollup_top_k` countries with the most editors in the window
+DEST_TABLES['rollup_top_countries'] = OrderedDict([
+    ('project', 'VARCHAR(255)'),
+    ('country', 'VARCHAR(255)'),
+    ('cohort', 'VARCHAR(255)'),
+    ('start', 'DATE'),
+    ('end', 'DATE'),
+    ('window_days', 'INT'),
+    ('country_rank', 'INT'),
+    ('count', 'INT'),
+    ('ts', 'TIMESTAMP')])
+
+# per project sums over the countries of each group of `--country_groups`,
+# e.g. group_set 'Region', group_name 'Asia & Pacific'. Like those of the
+# breakdown below, the short columns keep the primary key within InnoDB's
+# 3072 byte limit.
+DEST_TABLES['rollup_group'] = OrderedDict([
+    ('project', 'VARCHAR(255)'),
+    ('group_set', 'VARCHAR(64)'),
+    ('group_name', 'VARCHAR(64)'),
+    ('cohort', 'VARCHAR(32)'),
+    ('start', 'DATE'),
+    ('end', 'DATE'),
+    ('window_days', 'INT'),
+    ('count', 'INT'),
+    ('ts', 'TIMESTAMP')])
+
+# active editors by country per slice of the `--dimensions` of process_data,
+# e.g. dimensions 'namespace,type' and slice '1,1' for page creations in
+# namespace 1. The main datasets are the namespace 0 slices. The short
+# columns keep the primary key within InnoDB's 3072 byte limit, even with
+# 4 byte characters.
+DEST_TABLES['active_editors_breakdown'] = OrderedDict([
+    ('project', 'VARCHAR(255)'),
+    ('dimensions', 'VARCHAR(64)'),
+    ('slice', 'VARCHAR(64)'),
+    ('country', 'VARCHAR(255)'),
+    ('cohort', 'VARCHAR(32)'),
+    ('start', 'DATE'),
+    ('end', 'DATE'),
+    ('window_days', 'INT'),
+    ('count', 'INT'),
+    ('ts', 'TIMESTAMP')])
+
+# natural primary keys, so that REPLACE INTO overwrites the rows of a window
+# that is recomputed instead of adding duplicates
+DEST_TABLE_KEYS = {
+    'active_editors_country': ['project', 'country', 'cohort', 'start', 'end'],
+    'active_editors_world': ['project', 'cohort', 'start', 'end'],
+    'city_edit_fraction': ['project', 'country', 'city', 'start', 'end'],
+    'country_total_edit': ['project', 'country', 'start', 'end'],
+    'rollup_project': ['project', 'cohort', 'start', 'end'],
+    'rollup_top_countries': ['project', 'country', 'cohort', 'start', 'end'],
+    'rollup_group': ['project', 'group_set', 'group_name', 'cohort', 'start', 'end'],
+    'active_editors_breakdown': ['project', 'dimensions', 'slice', 'country', 'cohort', 'start', 'end'],
+}
+
+# secondary indexes backing the queries of scripts/make_limn_files.py, as
+# {table id : [(index name suffix, columns)]}. `window_days` lets the
+# `window_days = 30` filter of those queries use the index.
+DEST_TABLE_INDEXES = {
+    'active_editors_country': [('project', ['project', 'window_days', 'end']),
+                               ('country', ['country', 'window_days', 'end'])],
+    'active_editors_world': [('project', ['project', 'window_days', 'end'])],
+    'city_edit_fraction': [('project', ['project', 'window_days', 'end'])],
+    'country_total_edit': [('project', ['project', 'window_days', 'end'])],
+    'rollup_project': [('project', ['project', 'window_days', 'end'])],
+    'rollup_top_countries': [('project', ['project', 'window_days', 'end'])],
+    'rollup_group': [('group_set', ['group_set', 'window_days', 'end'])],
+    'active_editors_breakdown': [('project', ['project', 'dimensions', 'window_days', 'end'])],
+}
 
-def create_dest_tables(cursor, opts):
 
-    for table_id, field_types in DEST_TABLES.items():
+def get_create_command(table_id, table_name):
+    '''Returns the CREATE TABLE statement for `table_name`, with its primary key'''
+    field_str = ',\n'.join(map(' '.join, DEST_TABLES[table_id].items()))
+    return 'CREATE TABLE IF NOT EXISTS %s (%s,\nPRIMARY KEY (%s))' % (
+        table_name, field_str, ', '.join(DEST_TABLE_KEYS[table_id]))
+
+
+def get_index_commands(table_id, table_name):
+    '''Returns the CREATE INDEX statements of `DEST_TABLE_INDEXES` for `table_name`'''
+    return ['CREATE INDEX IF NOT EXISTS %s_%s ON %s (%s)' % (table_name, suffix, table_name, ', '.join(columns))
+            for (suffix, columns) in DEST_TABLE_INDEXES[table_id]]
+
+
+def rebuild_with_key(cursor, table_id, table_name):
+    '''Replaces `table_name` by a copy with the primary key of
+    `DEST_TABLE_KEYS`, without the duplicate rows it would reject
+    '''
+    new_name = '%s_keyed' % table_name
+    old_name = '%s_unkeyed' % table_name
+    columns = ', '.join(DEST_TABLES[table_id].keys())
+    cursor.execute('DROP TABLE IF EXISTS %s' % new_name)
+    cursor.execute(get_create_command(table_id, new_name))
+    # INSERT IGNORE keeps the first of duplicate rows, i.e. the latest one
+    cursor.execute('INSERT IGNORE INTO %s (%s) SELECT %s FROM %s ORDER BY ts DESC' % (
+        new_name, columns, columns, table_name))
+    cursor.execute('RENAME TABLE %s TO %s, %s TO %s' % (table_name, old_name, new_name, table_name))
+    cursor.execute('DROP TABLE %s' % old_name)
+
+
+def manage_dest_tables(cursor, opts):
+    '''Creates the destination tables, or migrates existing ones to the
+    current schema: adds and backfills `window_days`, renames `grouping` to
+    `group_set`, adds the primary key of `DEST_TABLE_KEYS` and the indexes of
+    `DEST_TABLE_INDEXES`.
+
+    A table without the primary key is rebuilt: its rows are copied into a
+    new table with the key, keeping the most recently written of duplicate
+    rows left by earlier runs, and the new table is renamed into its place.
+    '''
+    for table_id in DEST_TABLES:
         table_name = opts[table_id]
-        field_str = ',\n'.join(map(' '.join, field_types.items()))
-        command = 'CREATE TABLE IF NOT EXISTS %s (%s)' % (table_name, field_str)
-        cursor.execute(command)
+        cursor.execute(get_create_command(table_id, table_name))
+
+        cursor.execute('SHOW COLUMNS FROM %s' % table_name)
+        columns = [row[0] for row in cursor.fetchall()]
+        if 'window_days' not in columns:
+            logger.info('%s: adding and backfilling window_days', table_name)
+            cursor.execute('ALTER TABLE %s ADD COLUMN window_days INT AFTER end' % table_name)
+            cursor.execute('UPDATE %s SET window_days = DATEDIFF(end, start)' % table_name)
+        if 'grouping' in columns:
+            # a reserved word since MySQL 8.0
+            logger.info('%s: renaming grouping to group_set', table_name)
+            cursor.execute('ALTER TABLE %s CHANGE `grouping` group_set %s' % (table_name, DEST_TABLES[table_id]['group_set']))
+
+        cursor.execute('SHOW INDEX FROM %s' % table_name)
+        indexes = set(row[2] for row in cursor.fetchall())
+        if 'PRIMARY' not in indexes:
+            logger.info('%s: rebuilding with primary key (%s)', table_name, ', '.join(DEST_TABLE_KEYS[table_id]))
+            rebuild_with_key(cursor, table_id, table_name)
+            indexes = set(['PRIMARY'])
+        for (suffix, index_columns) in DEST_TABLE_INDEXES[table_id]:
+            index_name = '%s_%s' % (table_name, suffix)
+            if index_name not in indexes:
+                logger.info('%s: adding index %s', table_name, index_name)
+                cursor.execute('ALTER TABLE %s ADD INDEX %s (%s)' % (table_name, index_name, ', '.join(index_columns)))
     cursor.analytics_db.commit()
 
 
@@ -240,57 +428,68 @@ def get_dest_cursor(opts):
     #logging.debug('connecting to destination mysql instance with credentials from: %s', opts['dest_sql_cnf'])
     db = MySQLdb.connect(read_default_file=opts['dest_sql_cnf'], db=opts['dest_db_name'])
     cur = db.cursor(MySQLdb.cursors.Cursor)
-    #create_dest_tables(cur, opts)
     cur.analytics_db = db
     return cur
 
 
-def write_country_active_editors_mysql(active_editors_by_country, opts, cursor):
-    table_id = 'active_editors_country'
-    table = opts[table_id]
+def get_fields(table_id):
+    '''Returns the columns of the rows produced for `table_id`, i.e. those of `DEST_TABLES` without `ts`'''
     fields = DEST_TABLES[table_id].keys()
     fields.remove('ts')
-    dict_fmt = ', '.join(map(lambda f: '%%(%s)s' % f, fields))
-    query_fmt = """REPLACE INTO %s (%s) VALUES (%s);""" % (table, ','.join(fields), dict_fmt)
+    return fields
+
+
+def write_rows_mysql(table_id, rows, opts, cursor, batch_size=1000):
+    '''Writes the tuples `rows`, with the columns returned by `get_fields`,
+    to the table for `table_id`. `rows` can be any iterable and is consumed in
+    batches of `batch_size`. Returns the number of rows written.
+    '''
+    table = opts[table_id]
+    fields = get_fields(table_id)
+    query_fmt = """REPLACE INTO %s (%s) VALUES (%s);""" % (table, ','.join(fields), ', '.join(['%s'] * len(fields)))
     #logging.debug(query_fmt)
-    cursor.executemany(query_fmt, active_editors_by_country)
+    rows = iter(rows)
+    n = 0
+    while True:
+        batch = list(itertools.islice(rows, batch_size))
+        if not batch:
+            break
+        cursor.executemany(query_fmt, batch)
+        n += len(batch)
     cursor.analytics_db.commit()
+    return n
+
+
+def write_country_active_editors_mysql(active_editors_by_country, opts, cursor):
+    return write_rows_mysql('active_editors_country', active_editors_by_country, opts, cursor)
 
 
 def write_world_active_editors_mysql(world_active_editors, opts, cursor):
-    table_id = 'active_editors_world'
-    table = opts[table_id]
-    fields = DEST_TABLES[table_id].keys()
-    fields.remove('ts')
-    dict_fmt = ', '.join(map(lambda f: '%%(%s)s' % f, fields))
-    query_fmt = """REPLACE INTO %s (%s) VALUES (%s);""" % (table, ','.join(fields), dict_fmt)
-    cursor.executemany(query_fmt, world_active_editors)
-    cursor.analytics_db.commit()
+    return write_rows_mysql('active_editors_world', world_active_editors, opts, cursor)
 
 
 def write_city_edit_fraction_mysql(city_edit_fractions, opts, cursor):
-    table_id = 'city_edit_fraction'
-    table = opts[table_id]
-    fields = DEST_TABLES[table_id].keys()
-    fields.remove('ts')
-    dict_fmt = ', '.join(map(lambda f: '%%(%s)s' % f, fields))
-    query_fmt = """REPLACE INTO %s (%s) VALUES (%s);""" % (table, ','.join(fields), dict_fmt)
-    cursor.executemany(query_fmt, city_edit_fractions)
-    cursor.analytics_db.commit()
+    return write_rows_mysql('city_edit_fraction', city_edit_fractions, opts, cursor)
 
 
 def write_country_total_edits_mysql(country_totals, opts, cursor):
-    table_id = 'country_total_edit'
-    table = opts[table_id]
-    fields = DEST_TABLES[table_id].keys()
-    fields.remove('ts')
-    dict_fmt = ', '.join(map(lambda f: '%%(%s)s' % f, fields))
-    query_fmt = """REPLACE INTO %s (%s) VALUES (%s);""" % (table, ','.join(fields), dict_fmt)
-    cursor.executemany(query_fmt, country_totals)
-    cursor.analytics_db.commit()
+    return write_rows_mysql('country_total_edit', country_totals, opts, cursor)
+
+
+# the `_type` of each dataset in file names
+FILE_TYPES = {
+    'active_editors_country': 'country_active_editors',
+    'active_editors_world': 'world_active_editors',
+    'city_edit_fraction': 'city_fractions',
+    'country_total_edit': 'country_total_edits',
+    'rollup_project': 'project_rollup',
+    'rollup_top_countries': 'top_countries_rollup',
+    'rollup_group': 'group_rollup',
+    'active_editors_breakdown': 'active_editors_breakdown',
+}
 
 
-def get_filepath(_type, project, opts):
+def get_filepath(_type, project, opts, ext='json'):
     dt_fmt = '%Y%m%d'
     fn = '%s.%s' % (
         '_'.join(
@@ -299,11 +498,5 @@ def get_filepath(_type, project, opts):
              _type,
              opts['start'].strftime(dt_fmt),
              opts['end'].strftime(dt_fmt)]),
-        'json')
+        ext)
     return os.path.join(opts['output_dir'], opts['subdir'], fn)
-
-
-def dump_json(project, _type, rows, opts):
-    fp = get_filepath(_type, project, opts)
-    f = codecs.open(fp, encoding='utf-8', mode='w')
-    json.dump(rows, f, ensure_ascii=False)
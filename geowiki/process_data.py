@@ -13,17 +13,34 @@ import copy
 import datetime
 import dateutil.parser
 import dateutil.relativedelta
-import functools
+import errno
+import json
 import logging
+import multiprocessing
 import os
 import pprint
+import Queue
+import resource
+import signal
+import sys
+import time
 
+from collections import OrderedDict
 from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
 from operator import itemgetter
 
+import country_groups
+import extract_file
+import file_source
 import geo_coding as gc
+import geocode_cache
+import ledger
+import limn_files
 import wikipedia_projects
 import mysql_config
+import result_files
+import sampling
 import traceback
 
 
@@ -36,33 +53,295 @@ root_logger.setLevel(logging.DEBUG)
 logger = logging.getLogger(__name__)
 
 
+# seconds a worker has to be gone before its project is given up, so that the
+# result it sent just before exiting can still arrive
+WORKER_GRACE = 5
+
+# queue on which the tasks of a pool worker report their pid, see init_worker
+started_queue = None
+
+
 def run_parallel(opts):
     '''
-    Start `opts['threads']` processes that work through the list of projects `wp_projects`
+    Start `opts['threads']` processes that work through the list of projects `wp_projects`.
+    A failing project does not stop the others; returns the list of projects that failed.
+
+    If `opts['memory_budget']` is set, a project is only started while the
+    memory expected for the running projects, and the resident memory
+    actually used by their workers, leave room for it within the budget. The
+    memory a project needs is estimated from its peak RSS in previous runs,
+    or `opts['task_memory']` if it never ran. At least one project always runs.
+
+    A project whose worker dies without returning a result, e.g. when it is
+    killed for running out of memory, or that has not returned after
+    `opts['task_timeout']` hours, is recorded as failed, with the largest RSS
+    seen of its worker.
     '''
-    p = Pool(opts['threads'])
+    # a fresh process per project, so that ru_maxrss is the peak of that project
+    started = multiprocessing.Queue()
+    p = Pool(opts['threads'], initializer=init_worker, initargs=(started,), maxtasksperchild=1)
+
+    ledger_fn = ledger.get_ledger_fn(opts)
+    history = ledger.get_peak_rss(ledger_fn)
+    estimates = dict((wp_pr, history.get(wp_pr, opts['task_memory'] * 1024)) for wp_pr in opts['wp_projects'])
+    budget = opts['memory_budget'] * 1024 if opts['memory_budget'] else None
 
-    # wp_projects =  ['ar','pt','hi','en']
-    partial_process_project = functools.partial(process_project, opts=opts)
-    p.map(partial_process_project, opts['wp_projects'])
+    # largest first, smaller projects fill up the remaining budget
+    pending = sorted(opts['wp_projects'], key=estimates.get, reverse=True)
+    running = {}
+    submitted = {}
+    pids = {}
+    seen_rss = {}
+    gone = {}
+    finished = Queue.Queue()
+    results = []
+    lost = False
+    while pending or running:
+        while True:
+            try:
+                (wp_pr, pid) = started.get_nowait()
+            except Queue.Empty:
+                break
+            pids[wp_pr] = pid
+        used_rss = 0
+        for wp_pr in running:
+            rss = process_rss(pids[wp_pr]) if wp_pr in pids else None
+            if rss is not None:
+                used_rss += rss
+                seen_rss[wp_pr] = max(rss, seen_rss.get(wp_pr, 0))
 
+        while pending and len(running) < opts['threads']:
+            used = max(sum(running.values()), used_rss)
+            fits = [wp_pr for wp_pr in pending if budget is None or used + estimates[wp_pr] <= budget]
+            if not fits and running:
+                break
+            wp_pr = fits[0] if fits else pending[0]
+            pending.remove(wp_pr)
+            running[wp_pr] = estimates[wp_pr]
+            submitted[wp_pr] = time.time()
+            logger.debug('starting %s (estimated %d MB, %d MB in use)', wp_pr, estimates[wp_pr] / 1024, used / 1024)
+            p.apply_async(run_task, (wp_pr, opts), callback=finished.put)
+        try:
+            # wake up regularly to re-check the memory actually in use
+            result = finished.get(True, 10)
+        except Queue.Empty:
+            now = time.time()
+            for wp_pr in running:
+                error = None
+                if wp_pr in pids and not process_alive(pids[wp_pr]):
+                    gone.setdefault(wp_pr, now)
+                    if now - gone[wp_pr] >= WORKER_GRACE:
+                        error = 'worker process died'
+                elif opts['task_timeout'] and now - submitted[wp_pr] > opts['task_timeout'] * 3600:
+                    error = 'no result after %g hours' % opts['task_timeout']
+                    if wp_pr in pids:
+                        os.kill(pids[wp_pr], signal.SIGKILL)
+                if error is None:
+                    continue
+                logger.error('%s: %s', wp_pr, error)
+                ledger.finish(ledger_fn, ledger.get_unit(wp_pr, opts), 'failed', None, seen_rss.get(wp_pr))
+                lost = True
+                finished.put({
+                    'project': wp_pr,
+                    'status': 'failed',
+                    'error': error,
+                    'attempts': 0,
+                    'elapsed': now - submitted[wp_pr],
+                    'row_counts': None,
+                    'peak_rss': seen_rss.get(wp_pr),
+                })
+            continue
+        if result['project'] not in running:
+            logger.warning('%s: ignoring the result that arrived after the project was given up', result['project'])
+            continue
+        del running[result['project']]
+        results.append(result)
+        logger.info('%s: %s after %d attempt(s) in %.1fs, peak rss %d MB (%d/%d)', result['project'], result['status'],
+                    result['attempts'], result['elapsed'], (result['peak_rss'] or 0) / 1024,
+                    len(results), len(opts['wp_projects']))
+    if lost:
+        # the pool keeps waiting for the results of lost tasks on close
+        p.terminate()
+    else:
+        p.close()
+    p.join()
+
+    failed = sorted(r['project'] for r in results if r['status'] == 'failed')
+    write_run_summary(results, opts)
+    if failed:
+        logger.error('%d project(s) failed: %s', len(failed), ', '.join(failed))
     logger.info('All projects done. Results are in %s' % (opts['output_dir']))
+    return failed
 
 
-def mysql_resultset(wp_pr, start, end, opts):
+def process_rss(pid):
+    '''Returns the resident set size (in KB) of the process `pid`, or None if
+    it is not known
     '''
-    Returns an iterable MySql resultset using a server side cursor that can be
-    used to iterate the data. Alternavively, the `dump_data_iterator()` method
-    dumps the data onto disk before  aggregation.
+    try:
+        with open('/proc/%d/status' % pid) as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1])
+    except IOError:
+        pass
+    return None
+
+
+def process_alive(pid):
+    '''Returns False if the process `pid` is gone'''
+    try:
+        os.kill(pid, 0)
+    except OSError, e:
+        return e.errno != errno.ESRCH
+    return True
+
+
+def peak_rss():
+    '''Returns the peak resident set size (in KB) of this process'''
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def init_worker(queue):
+    '''Initializes a pool worker of `run_parallel`, whose tasks report their
+    project and pid on `queue`
     '''
-    # query = mysql_config.construct_rc_query(db_name)
-    query = mysql_config.construct_cu_query(wp_pr=wp_pr, start=start, end=end)
-    logger.debug("SQL query for %s for start=%s, end=%s:\n\t%s" % (wp_pr, start, end, query))
+    global started_queue
+    started_queue = queue
+
+
+def run_task(wp_pr, opts):
+    '''
+    The function run by the pool workers. Never raises, as the scheduler in
+    `run_parallel` waits for one result per project.
+    '''
+    if started_queue is not None:
+        started_queue.put((wp_pr, os.getpid()))
+    try:
+        return process_project_with_retries(wp_pr, opts)
+    except Exception, e:
+        logger.exception('caught exception within process:')
+        return {
+            'project': wp_pr,
+            'status': 'failed',
+            'error': repr(e),
+            'attempts': 0,
+            'elapsed': 0,
+            'row_counts': None,
+            'peak_rss': peak_rss(),
+        }
+
+
+def write_run_summary(results, opts):
+    '''Writes the per-project outcome of a run to `run_summary.json` in the run's subdir'''
+    summary = {
+        'start': opts['start'].isoformat(),
+        'end': opts['end'].isoformat(),
+        'failed': sorted(r['project'] for r in results if r['status'] == 'failed'),
+        'skipped': sorted(r['project'] for r in results if r['status'] == 'skipped'),
+        'max_peak_rss': max([r['peak_rss'] for r in results if r['peak_rss']] or [None]),
+        'projects': sorted(results, key=itemgetter('project')),
+    }
+    summary_fn = os.path.join(opts['output_dir'], opts['subdir'], 'run_summary.json')
+    with open(summary_fn, 'w') as f:
+        json.dump(summary, f, indent=2, sort_keys=True)
+
+
+def id_ranges(lo, hi, n):
+    '''Splits the ids `lo..hi` (inclusive) into at most `n` ranges (after, upto]'''
+    step = max(1, (hi - lo + n) // n)
+    return [(after, min(after + step, hi)) for after in range(lo - 1, hi, step)]
+
+
+def read_id_range(wp_pr, start, end, after, upto, opts, pages):
+    '''
+    Reads the checkuser rows with `after < cuc_id <= upto` page by page and
+    puts each page on the queue `pages`, followed by None once the range is
+    exhausted. Every page resumes after the last `cuc_id` read, so a transient
+    database error only rereads the current page. Non-transient errors, and
+    transient ones after `opts['read_retries']` retries of the same page, are
+    put on the queue instead.
+    '''
+    id_idx = mysql_config.CU_FIELDS.index('cuc_id')
+    attempt = 0
+    db = None
+    try:
+        while after < upto:
+            try:
+                if db is None:
+                    db = mysql_config.get_analytics_db_connection(wp_pr, opts)
+                cur = db.cursor()
+                cur.execute(mysql_config.construct_cu_range_query(wp_pr, start, end, after, upto, opts['page_size'],
+                                                                  opts['dimensions'], opts['sample']))
+                page = cur.fetchall()
+                cur.close()
+                attempt = 0
+            except Exception, e:
+                if not mysql_config.is_transient_error(e) or attempt >= opts['read_retries']:
+                    raise
+                attempt += 1
+                logger.warning('%s: reading cuc_id range (%d, %d] failed (%s), retry %d/%d',
+                               wp_pr, after, upto, e, attempt, opts['read_retries'])
+                if db is not None:
+                    try:
+                        db.close()
+                    except Exception:
+                        pass
+                    db = None
+                time.sleep(opts['retry_backoff'] * 2 ** (attempt - 1))
+                continue
+            if page:
+                pages.put(page)
+                after = page[-1][id_idx]
+            if len(page) < opts['page_size']:
+                break
+        pages.put(None)
+    except Exception, e:
+        logger.exception('%s: giving up on cuc_id range (%d, %d]', wp_pr, after, upto)
+        pages.put(e)
+    finally:
+        if db is not None:
+            db.close()
 
-    cur = mysql_config.get_analytics_cursor(wp_pr, opts, server_side=True)
+
+def keyset_resultset(wp_pr, start, end, opts):
+    '''
+    Yields the checkuser rows of `wp_pr` between `start` and `end`. Instead of
+    one long-running query, the `cuc_id`s of the window are split into
+    `opts['read_ranges']` ranges that are read with keyset pagination by
+    `opts['read_threads']` threads. Rows are yielded in no particular order,
+    with the columns of `mysql_config.get_cu_fields(opts['dimensions'])`.
+    '''
+    query = mysql_config.construct_cu_id_bounds_query(wp_pr, start, end)
+    logger.debug("SQL query for %s for start=%s, end=%s:\n\t%s" % (wp_pr, start, end, query))
+    cur = mysql_config.get_analytics_cursor(wp_pr, opts, server_side=False)
     cur.execute(query)
+    (lo, hi) = cur.fetchone()
+    cur.close()
+    if lo is None:
+        return
+
+    ranges = id_ranges(lo, hi, opts['read_ranges'])
+    logger.debug('%s: reading cuc_id %d..%d in %d ranges', wp_pr, lo, hi, len(ranges))
+    # bounded, so that readers can not run far ahead of the aggregation
+    pages = Queue.Queue(maxsize=2 * opts['read_threads'])
+    pool = ThreadPool(opts['read_threads'])
+    for (after, upto) in ranges:
+        pool.apply_async(read_id_range, (wp_pr, start, end, after, upto, opts, pages))
+    pool.close()
 
-    return cur
+    remaining = len(ranges)
+    while remaining:
+        page = pages.get()
+        if page is None:
+            remaining -= 1
+        elif isinstance(page, Exception):
+            pool.terminate()
+            raise page
+        else:
+            for row in page:
+                yield row
+    pool.join()
 
 
 def retrieve_bot_list(wp_pr, opts):
@@ -70,11 +349,15 @@ def retrieve_bot_list(wp_pr, opts):
     Returns a set of all known bots for `wp_pr`. Bots are not labeled in a
     chohesive manner for Wikipedia. We use the union of the bots used for the
     [Wikipedia statistics](stats.wikimedia.org/), stored in `./data/erikZ.bots`
-    and the `user_group.ug_group='bot'` flag in the MySql database.
+    and the `user_group.ug_group='bot'` flag in the MySql database (or the
+    bots exported next to an offline source).
     '''
     bot_fn = os.path.join(os.path.split(__file__)[0], 'data', 'erikZ.bots')
     erikZ_bots = set(long(b) for b in open(bot_fn, 'r'))
 
+    if opts['source'] != 'mysql':
+        return erikZ_bots.union(file_source.retrieve_bot_ids(wp_pr, opts))
+
     query = mysql_config.construct_bot_query(wp_pr)
     cur = mysql_config.get_analytics_cursor(wp_pr, opts, server_side=False)
     cur.execute(query)
@@ -88,38 +371,131 @@ def retrieve_bot_list(wp_pr, opts):
     return erikZ_bots.union(pr_bots)
 
 
-def process_project(wp_pr, opts):
+def get_source(wp_pr, opts):
+    '''Returns an iterable over the checkuser rows of `wp_pr` for the window
+    `opts['start']` to `opts['end']`, from the replica or an offline export
+    '''
+    if opts['source'] == 'mysql':
+        ### read the result set in restartable cuc_id ranges
+        return keyset_resultset(wp_pr, opts['start'], opts['end'], opts)
+    return file_source.resultset(wp_pr, opts['start'], opts['end'], opts)
 
+
+def get_datasets(wp_pr, editors, cities, opts, slices=None):
+    '''
+    Tallies `editors` and returns {table_id : rows_fn} for the datasets and
+    rollups of `wp_pr`. Each rows_fn() returns a new generator over the rows of the
+    dataset, as tuples in `mysql_config.DEST_TABLES` column order, so every
+    sink streams the rows without a full result list being built. The
+    {slice : editors} `slices` of the `--dimensions` make up the breakdown,
+    which is empty without them. The counts of a `--sample` run are scaled to
+    estimates of the full counts.
+    '''
+    (country_nest, world_nest) = gc.tally_active_editors(editors)
+    slice_nests = {}
+    for slice_, slice_editors in (slices or {}).iteritems():
+        slice_nests[slice_] = gc.tally_active_editors(slice_editors)[0]
+    if opts['sample']:
+        country_nest = sampling.scale(country_nest, opts['sample'])
+        world_nest = sampling.scale(world_nest, opts['sample'])
+        cities = sampling.scale(cities, opts['sample'])
+        slice_nests = sampling.scale(slice_nests, opts['sample'])
+    return OrderedDict([
+        ('active_editors_country', lambda: gc.country_active_editor_rows(wp_pr, country_nest, opts)),
+        ('active_editors_world', lambda: gc.world_active_editor_rows(wp_pr, world_nest, opts)),
+        ('city_edit_fraction', lambda: gc.city_fraction_rows(wp_pr, cities, opts)),
+        ('country_total_edit', lambda: gc.country_total_edit_rows(wp_pr, cities, opts)),
+        ('rollup_project', lambda: gc.project_rollup_rows(wp_pr, country_nest, opts)),
+        ('rollup_top_countries', lambda: gc.top_country_rollup_rows(wp_pr, country_nest, opts)),
+        ('rollup_group', lambda: gc.group_rollup_rows(wp_pr, country_nest, opts)),
+        ('active_editors_breakdown', lambda: gc.breakdown_rows(wp_pr, slice_nests, opts)),
+    ])
+
+
+def process_project(wp_pr, opts):
+    '''
+    Creates and writes the datasets of `wp_pr` for the window `opts['start']`
+    to `opts['end']`. Returns the number of rows written for each dataset.
+    '''
     try:
         logger.info('CREATING DATASET FOR %s' % wp_pr)
 
-        ### use a server-side cursor to iterate the result set
-        source = mysql_resultset(wp_pr, opts['start'], opts['end'], opts)
         bots = retrieve_bot_list(wp_pr, opts)
-        (editors, cities) = gc.extract(source=source, filter_ids=bots, geoIP_db=opts['geoIP_db'])
+        geo_cache = None
+        if opts['geo_cache']:
+            geo_cache = geocode_cache.GeocodeCache(opts['geo_cache'], opts['geoip_version'])
+        try:
+            if opts['source'] == 'extract':
+                ### re-aggregate a previously written extract file
+                (header, columns) = extract_file.read_extract(os.path.join(opts['source_path'], extract_file.get_extract_fn(wp_pr, opts)))
+                (users, ips) = (columns['user'], columns['ip'])
+                if opts['sample']:
+                    sampled = users % opts['sample'] == 0
+                    (users, ips) = (users[sampled], ips[sampled])
+                (editors, cities) = gc.extract_arrays(users, ips, filter_ids=bots,
+                                                      geoIP_db=opts['geoIP_db'], geo_cache=geo_cache)
+                slices = None
+            else:
+                source = get_source(wp_pr, opts)
+                dimensions = opts['dimensions']
+                main_slice = gc.get_main_slice(dimensions)
+                writer = None
+                if opts['write_extract']:
+                    writer = extract_file.ExtractWriter(
+                        os.path.join(opts['output_dir'], opts['subdir'], extract_file.get_extract_fn(wp_pr, opts)), wp_pr, opts)
+                    # extract files hold the rows of the main datasets only, while
+                    # extract also needs the other slices
+                    source = writer.tee(source, keep=lambda row: row[0] not in bots and (
+                        main_slice is None or main_slice(row[-len(dimensions):])))
+                try:
+                    result = gc.extract(source=source, filter_ids=bots, geoIP_db=opts['geoIP_db'], geo_cache=geo_cache,
+                                        spill_threshold=opts['spill_threshold'], spill_dir=opts['spill_dir'],
+                                        dimensions=len(dimensions), main_slice=main_slice)
+                except:
+                    if writer is not None:
+                        writer.abort()
+                    raise
+                if dimensions:
+                    (editors, cities, slices) = result
+                else:
+                    (editors, cities) = result
+                    slices = None
+                if writer is not None:
+                    writer.close()
+        finally:
+            # also writes the pending entries when geocoding failed
+            if geo_cache is not None:
+                geo_cache.close()
 
         # aggregate
         logging.debug('tallying')
-        country_active_editors, world_active_editors = gc.get_active_editors(wp_pr, editors, opts)
-        city_fractions, country_total_edits = gc.get_city_edits(wp_pr, cities, opts)
+        datasets = get_datasets(wp_pr, editors, cities, opts, slices)
 
         # write to db
-        logging.debug('writing to db')
-        cursor = mysql_config.get_dest_cursor(opts)
-        mysql_config.write_country_active_editors_mysql(country_active_editors, opts, cursor=cursor)
-        mysql_config.write_world_active_editors_mysql(country_active_editors, opts, cursor=cursor)
-        mysql_config.write_city_edit_fraction_mysql(city_fractions, opts, cursor=cursor)
-        mysql_config.write_country_total_edits_mysql(country_total_edits, opts, cursor=cursor)
-        cursor.close()
+        row_counts = {}
+        if not opts['skip_mysql']:
+            logging.debug('writing to db')
+            cursor = mysql_config.get_dest_cursor(opts)
+            for table_id, rows_fn in datasets.items():
+                row_counts[table_id] = mysql_config.write_rows_mysql(table_id, rows_fn(), opts, cursor=cursor)
+            cursor.close()
 
         # write files
         logging.debug('writing to files')
-        #mysql_config.dump_json(wp_pr, 'country_active_editors', country_active_editors, opts)
-        #mysql_config.dump_json(wp_pr, 'world_active_editors', world_active_editors, opts)
-        #mysql_config.dump_json(wp_pr, 'city_fractions', city_fractions, opts)
-        #mysql_config.dump_json(wp_pr, 'country_total_edits', country_total_edits, opts)
+        for table_id in opts['write_files']:
+            row_counts[table_id] = result_files.write_rows(wp_pr, table_id, datasets[table_id](), opts)
+
+        # write the error estimates of a sampled run
+        if opts['sample']:
+            row_counts[sampling.REPORT_TYPE] = sampling.write_report(wp_pr, datasets, opts)
+
+        # update the limn datafiles
+        if opts['limn_basedir_private'] or opts['limn_basedir_public']:
+            logging.debug('updating limn datafiles')
+            limn_files.update_project(wp_pr, datasets, opts)
 
         logger.info('Done : %s' % wp_pr)
+        return row_counts
     except:
         """
         this is the function which the multiprocessing pool maps
@@ -130,6 +506,58 @@ def process_project(wp_pr, opts):
         raise
 
 
+def process_project_with_retries(wp_pr, opts):
+    '''
+    Runs `process_project` for `wp_pr`, retrying transient database errors up
+    to `opts['max_attempts']` times with exponential backoff. Never raises, so
+    that one failing project does not abort the run; returns a dict
+    describing the outcome instead. Units that the ledger says are done (with
+    `--resume`) or claimed by another process are skipped.
+    '''
+    t0 = time.time()
+    ledger_fn = ledger.get_ledger_fn(opts)
+    unit = ledger.get_unit(wp_pr, opts)
+    if not ledger.claim(ledger_fn, unit, opts['resume'], opts['stale_claim'] * 3600):
+        return {
+            'project': wp_pr,
+            'status': 'skipped',
+            'error': None,
+            'attempts': 0,
+            'elapsed': time.time() - t0,
+            'row_counts': None,
+            'peak_rss': None,
+        }
+
+    attempt = 0
+    row_counts = None
+    while True:
+        attempt += 1
+        try:
+            row_counts = process_project(wp_pr, opts)
+            status, error = 'done', None
+            break
+        except Exception, e:
+            if mysql_config.is_transient_error(e) and attempt < opts['max_attempts']:
+                delay = opts['retry_backoff'] * 2 ** (attempt - 1)
+                logger.warning('%s: transient error (%s), retrying in %ds (attempt %d/%d)',
+                               wp_pr, e, delay, attempt, opts['max_attempts'])
+                time.sleep(delay)
+                continue
+            status, error = 'failed', repr(e)
+            break
+    rss = peak_rss()
+    ledger.finish(ledger_fn, unit, status, row_counts, rss)
+    return {
+        'project': wp_pr,
+        'status': status,
+        'error': error,
+        'attempts': attempt,
+        'elapsed': time.time() - t0,
+        'row_counts': row_counts,
+        'peak_rss': rss,
+    }
+
+
 def parse_args():
 
     class WPFileAction(argparse.Action):
@@ -251,6 +679,124 @@ def parse_args():
         dest='threads',
         help="number of threads"
     )
+    parser.add_argument(
+        '--source',
+        choices=['mysql', 'tsv', 'sqlite', 'extract'],
+        default='mysql',
+        help='where to read the checkuser data from: the replica databases, gzipped tsv exports of cu_changes, '
+        'per-wiki sqlite files or extract files written with --write_extract in --source_path'
+    )
+    parser.add_argument(
+        '--source_path',
+        metavar='dir',
+        type=os.path.expanduser,
+        default='.',
+        help='<path> to the directory containing the <db_name>*.tsv.gz or <db_name>.sqlite exports '
+        'or the extract files used with --source tsv|sqlite|extract'
+    )
+    parser.add_argument(
+        '--write_extract',
+        action='store_true',
+        default=False,
+        help='also write the filtered (user, ip, timestamp) rows of each project to a compact binary '
+        '<BASENAME>_wp_pr_extract_start_end.bin file, which can be re-aggregated with --source extract'
+    )
+    parser.add_argument(
+        '--read_ranges',
+        type=int,
+        default=8,
+        help='number of cuc_id ranges the checkuser scan of each project is split into'
+    )
+    parser.add_argument(
+        '--read_threads',
+        type=int,
+        default=1,
+        help='number of ranges (or tsv files) of a project read in parallel, each over its own connection'
+    )
+    parser.add_argument(
+        '--page_size',
+        type=int,
+        default=100000,
+        help='number of checkuser rows fetched per query when reading a range'
+    )
+    parser.add_argument(
+        '--read_retries',
+        type=int,
+        default=5,
+        help='number of times a page is retried after a transient database error'
+    )
+    parser.add_argument(
+        '--max_attempts',
+        type=int,
+        default=3,
+        help='number of times a project is attempted when it fails with a transient database error'
+    )
+    parser.add_argument(
+        '--retry_backoff',
+        type=float,
+        default=30,
+        help='seconds to wait before the first retry of a project or page; doubled on every further retry'
+    )
+    parser.add_argument(
+        '--resume',
+        action='store_true',
+        default=False,
+        help='skip (project, start, end, GeoIP version) units that the ledger records as done with the '
+        'same options that change what is written, e.g. --dimensions, --sample or --write_files'
+    )
+    parser.add_argument(
+        '--ledger',
+        metavar='ledger.sqlite',
+        type=os.path.expanduser,
+        default=None,
+        help='<path> to the sqlite ledger recording finished units of work. Defaults to %s in the output dir' % ledger.LEDGER_FN
+    )
+    parser.add_argument(
+        '--stale_claim',
+        metavar='hours',
+        type=float,
+        default=24,
+        help='hours after which a unit claimed by a process on another host, which can not be checked, '
+        'is considered abandoned and processed again'
+    )
+    parser.add_argument(
+        '--spill_threshold',
+        metavar='MB',
+        type=int,
+        default=None,
+        help='approximate memory for per-editor counts of a project above which they are spilled to sorted '
+        'run files and merged when tallying. If not given, all counts are kept in memory'
+    )
+    parser.add_argument(
+        '--spill_dir',
+        metavar='dir',
+        type=os.path.expanduser,
+        default=None,
+        help='<path> to the directory for spilled run files. Defaults to the system temp dir'
+    )
+    parser.add_argument(
+        '--memory_budget',
+        metavar='MB',
+        type=int,
+        default=None,
+        help='only start another project while the memory expected for the running projects stays within '
+        'this many MB. If not given, only --threads limits concurrency'
+    )
+    parser.add_argument(
+        '--task_memory',
+        metavar='MB',
+        type=int,
+        default=1024,
+        help='memory assumed for a project that has no peak rss recorded in the ledger from previous runs'
+    )
+    parser.add_argument(
+        '--task_timeout',
+        metavar='hours',
+        type=float,
+        default=None,
+        help='record a project as failed, and kill its worker, if it has not finished after this many hours. '
+        'If not given, projects can run for any time'
+    )
     parser.add_argument(
         '-q', '--quiet',
         action='store_true',
@@ -264,6 +810,14 @@ def parse_args():
         dest='geoIP_db',
         help='<path> to geo IP database'
     )
+    parser.add_argument(
+        '--geo_cache',
+        metavar='cache.sqlite',
+        type=os.path.expanduser,
+        default=None,
+        help='<path> to a sqlite file in which geocoded ips are cached and shared by all projects and days '
+        'of a run (and by later runs using the same GeoIP database). If not given, every ip is resolved with GeoIP'
+    )
     parser.add_argument(
         '--top_cities',
         type=int,
@@ -286,6 +840,80 @@ def parse_args():
         'for use with the write_*_sql output options.  For more information, see '
         'http://dev.mysql.com/doc/refman/5.1/en/option-files.html'
     )
+    parser.add_argument(
+        '--skip_mysql',
+        action='store_true',
+        default=False,
+        help='do not write results to the destination database, e.g. when only writing files with --write_files'
+    )
+    parser.add_argument(
+        '--rollup_top_k',
+        type=int,
+        default=25,
+        help='number of countries per project and window stored in the top countries rollup'
+    )
+    parser.add_argument(
+        '--country_groups',
+        help='json file of {grouping : {country : group name}}, e.g. {"Region" : {"Ghana" : "Africa"}}, '
+        'or the country classification cache of make_limn_files.py, used for the group rollup. '
+        'Without it the group rollup stays empty'
+    )
+    parser.add_argument(
+        '--sample',
+        metavar='N',
+        type=int,
+        help='preview run on the users whose id is a multiple of N. Counts are scaled by N and a tsv report '
+        'of the estimates with 95%% confidence intervals is written next to the result files. Nothing is '
+        'written to the destination database, and results go to their own subdir and ledger'
+    )
+    parser.add_argument(
+        '--dimensions',
+        nargs='+',
+        choices=mysql_config.DIMENSIONS.keys(),
+        default=[],
+        help='also count active editors by country per value of these dimensions of the checkuser rows, '
+        'in the same scan, into the breakdown table. With namespace, all namespaces are read and '
+        'the other datasets keep counting namespace 0 only'
+    )
+    parser.add_argument(
+        '--skip_manage_schema',
+        action='store_true',
+        default=False,
+        help='do not create the destination tables or migrate them to the current schema (rollup tables, '
+        'primary keys, indexes and the window_days column) before processing. Only use it when the schema '
+        'is known to be current, as writing to an old schema fails'
+    )
+    parser.add_argument(
+        '--write_files',
+        nargs='+',
+        choices=mysql_config.DEST_TABLES.keys(),
+        default=[],
+        help='datasets to also write to per-project files <BASENAME>_wp_pr_type_start_end.<format> in the output dir'
+    )
+    parser.add_argument(
+        '--file_format',
+        choices=result_files.FORMATS,
+        default='jsonl',
+        help='format of the files written with --write_files. json writes a single list, as read by restore_from_files.py'
+    )
+    parser.add_argument(
+        '--file_compression',
+        choices=sorted(result_files.COMPRESSIONS.keys()),
+        default='gzip',
+        help='compression of the files written with --write_files'
+    )
+    parser.add_argument(
+        '--limn_basedir_private',
+        type=os.path.expanduser,
+        help='data repository whose per project datafiles by country (<project>_all, <project>_top<k>) '
+        'are updated with the computed 30 day windows, as --basedir_private of make_limn_files.py'
+    )
+    parser.add_argument(
+        '--limn_basedir_public',
+        type=os.path.expanduser,
+        help='data repository whose per project editor counts datafiles are updated with the computed '
+        '30 day windows, as --basedir_public of make_limn_files.py'
+    )
     parser.add_argument(
         '--dest_db_name',
         default='staging',
@@ -312,6 +940,26 @@ def parse_args():
         default=mysql_config.DEST_TABLE_NAMES['country_total_edit'],
         help='table in `dest_sql` db in which the total number of edits from a given country will be stored'
     )
+    parser.add_argument(
+        '--rollup_project',
+        default=mysql_config.DEST_TABLE_NAMES['rollup_project'],
+        help='table in `dest_sql` db in which the per project active editor sums will be stored'
+    )
+    parser.add_argument(
+        '--rollup_top_countries',
+        default=mysql_config.DEST_TABLE_NAMES['rollup_top_countries'],
+        help='table in `dest_sql` db in which the active editors of the top countries of each project will be stored'
+    )
+    parser.add_argument(
+        '--rollup_group',
+        default=mysql_config.DEST_TABLE_NAMES['rollup_group'],
+        help='table in `dest_sql` db in which the active editors per group of countries will be stored'
+    )
+    parser.add_argument(
+        '--active_editors_breakdown',
+        default=mysql_config.DEST_TABLE_NAMES['active_editors_breakdown'],
+        help='table in `dest_sql` db in which the active editors by country per slice of --dimensions will be stored'
+    )
 
     # post processing
     args = parser.parse_args()
@@ -319,9 +967,21 @@ def parse_args():
         args.start = args.end - dateutil.relativedelta.relativedelta(months=1)
 
     cu_start = datetime.date.today() - datetime.timedelta(days=90)
-    if args.daily and args.start < cu_start + datetime.timedelta(days=30):
+    if args.daily and args.source == 'mysql' and args.start < cu_start + datetime.timedelta(days=30):
         parser.error('starting date (%s) exceeds persistence of check_user table (90 days, i.e. %s)' % (args.start, cu_start))
 
+    if args.sample is not None:
+        if args.sample < 2:
+            parser.error('--sample needs N >= 2')
+        if args.limn_basedir_private or args.limn_basedir_public:
+            parser.error('--sample previews can not update limn datafiles')
+        args.skip_mysql = True
+        if not args.ledger:
+            args.ledger = os.path.join(args.output_dir, ledger.LEDGER_FN.replace('.sqlite', '_sample%d.sqlite' % args.sample))
+
+    if args.dimensions and args.source == 'extract':
+        parser.error('extract files hold no --dimensions, read them from another --source')
+
     wp_projects = wikipedia_projects.check_validity(args.wp_projects)
     if not wp_projects:
         parser.error('no valid wikipedia projects recieved\n'
@@ -341,6 +1001,11 @@ def parse_args():
     args.subdir = '%s_%s' % (
         datetime.date.strftime(args.start, '%Y%m%d'),
         datetime.date.strftime(args.end, '%Y%m%d'))
+    if args.sample:
+        # mark both the dir and the files, so that restore_from_files.py can
+        # tell the scaled estimates from production results
+        args.subdir += '_sample%d' % args.sample
+        args.basename += '_sample%d' % args.sample
 
     # check for mysql login credentials
     if not os.path.exists(os.path.expanduser("~/.my.cnf")):
@@ -351,10 +1016,22 @@ def parse_args():
 
 
 def main():
-    """Entry point for geo coding package
+    """Entry point for geo coding package. Returns a non-zero exit status if
+    any project failed.
     """
 
     opts = parse_args()
+    failed = []
+    opts['geoip_version'] = gc.get_geoip_version(opts['geoIP_db'])
+    if opts['country_groups']:
+        opts['country_groups'] = country_groups.load_groups(opts['country_groups'])
+    ledger.init_ledger(ledger.get_ledger_fn(opts))
+    if opts['geo_cache']:
+        geocode_cache.init_cache(opts['geo_cache'])
+    if not opts['skip_manage_schema'] and not opts['skip_mysql']:
+        cursor = mysql_config.get_dest_cursor(opts)
+        mysql_config.manage_dest_tables(cursor, opts)
+        cursor.close()
     if opts['daily']:
         orig_start = copy.deepcopy(opts['start'])
         orig_end = copy.deepcopy(opts['end'])
@@ -366,6 +1043,8 @@ def main():
             opts['subdir'] = './%s_%s' % (
                 datetime.date.strftime(opts['start'], '%Y%m%d'),
                 datetime.date.strftime(opts['end'], '%Y%m%d'))
+            if opts['sample']:
+                opts['subdir'] += '_sample%d' % opts['sample']
 
             if not os.path.exists(os.path.join(opts['output_dir'], opts['subdir'])):
                 os.makedirs(os.path.join(opts['output_dir'], opts['subdir']))
@@ -376,16 +1055,23 @@ def main():
 
             logger.info('running daily with options: %s', pprint.pformat(opts, indent=2))
 
-            run_parallel(opts)
+            failed.extend('%s@%s' % (wp_pr, day) for wp_pr in run_parallel(opts))
     else:
         if not os.path.exists(os.path.join(opts['output_dir'], opts['subdir'])):
             os.makedirs(os.path.join(opts['output_dir'], opts['subdir']))
         logger.addHandler(logging.FileHandler(os.path.join(opts['output_dir'], opts['subdir'], 'log')))
-        run_parallel(opts)
+        failed.extend(run_parallel(opts))
+
+    if failed:
+        logger.error('run finished with %d failed project(s): %s', len(failed), ', '.join(failed))
+        return 1
+    return 0
 
 if __name__ == '__main__':
     try:
-        main()
+        sys.exit(main())
+    except SystemExit:
+        raise
     except:
         logger.error(traceback.format_exc())
         raise
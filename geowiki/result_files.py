@@ -0,0 +1,156 @@
+'''
+
+Per-project result files.
+
+Rows of the datasets enabled with `--write_files` are streamed to
+`<output_dir>/<subdir>/<basename>_<project>_<type>_<start>_<end>.<ext>` as
+they are produced. Supported formats are a json list (the format read by
+`scripts/restore_from_files.py`), json lines and tsv with a header line, each
+optionally compressed with gzip or zstd. Files are written to a temporary
+file in the same directory and renamed into place, so readers never see a
+half-written file. `read_rows` reads any of them back.
+
+'''
+
+import gzip
+import io
+import json
+import logging
+import os
+import tempfile
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+import mysql_config
+
+logger = logging.getLogger(__name__)
+
+FORMATS = ['json', 'jsonl', 'tsv']
+
+COMPRESSIONS = {
+    'none': '',
+    'gzip': '.gz',
+    'zstd': '.zst',
+}
+
+
+def get_result_fn(wp_pr, table_id, opts):
+    ext = opts['file_format'] + COMPRESSIONS[opts['file_compression']]
+    return mysql_config.get_filepath(mysql_config.FILE_TYPES[table_id], wp_pr, opts, ext=ext)
+
+
+def open_compressed(f, compression):
+    '''Returns a writable file object compressing into the open file `f`'''
+    if compression == 'gzip':
+        return gzip.GzipFile(fileobj=f, mode='wb')
+    elif compression == 'zstd':
+        if zstandard is None:
+            raise ImportError('zstd compression requires the zstandard module')
+        return zstandard.ZstdCompressor().stream_writer(f)
+    return f
+
+
+def finish_compressed(out, compression):
+    '''Writes the end of the compressed stream `out` without closing the underlying file'''
+    if compression == 'gzip':
+        out.close()
+    elif compression == 'zstd':
+        out.flush(zstandard.FLUSH_FRAME)
+
+
+def tsv_value(v):
+    if v is None:
+        return '\\N'
+    if isinstance(v, unicode):
+        v = v.encode('utf-8')
+    return str(v).replace('\t', ' ').replace('\n', ' ')
+
+
+def write_rows(wp_pr, table_id, rows, opts):
+    '''Streams the tuples `rows` of `table_id` to the result file of `wp_pr`
+    in `opts['file_format']` and `opts['file_compression']`. Returns the
+    number of rows written.
+    '''
+    fn = get_result_fn(wp_pr, table_id, opts)
+    fields = mysql_config.get_fields(table_id)
+    (fd, tmp_fn) = tempfile.mkstemp(dir=os.path.dirname(fn), prefix='.%s.' % os.path.basename(fn))
+    raw = os.fdopen(fd, 'wb')
+    try:
+        out = open_compressed(raw, opts['file_compression'])
+        n = 0
+        if opts['file_format'] == 'tsv':
+            out.write('\t'.join(fields) + '\n')
+            for row in rows:
+                out.write('\t'.join(map(tsv_value, row)) + '\n')
+                n += 1
+        else:
+            obj_fmt = '{%s}' % ', '.join('"%s": %%s' % f for f in fields)
+            if opts['file_format'] == 'json':
+                out.write('[')
+            for row in rows:
+                obj = obj_fmt % tuple(json.dumps(v) for v in row)
+                if opts['file_format'] == 'json':
+                    out.write(', ' + obj if n else obj)
+                else:
+                    out.write(obj + '\n')
+                n += 1
+            if opts['file_format'] == 'json':
+                out.write(']')
+        finish_compressed(out, opts['file_compression'])
+        raw.flush()
+        os.fsync(raw.fileno())
+        raw.close()
+        os.chmod(tmp_fn, 0o644)
+        os.rename(tmp_fn, fn)
+    except:
+        raw.close()
+        os.remove(tmp_fn)
+        raise
+    logger.debug('wrote %d rows to %s', n, fn)
+    return n
+
+
+def open_decompressed(fn):
+    '''Returns a readable file object for `fn`, decompressed according to its extension'''
+    if fn.endswith('.gz'):
+        return gzip.open(fn, 'rb')
+    elif fn.endswith('.zst'):
+        if zstandard is None:
+            raise ImportError('zstd compression requires the zstandard module')
+        # the decompression reader supports neither readline nor iteration
+        return io.BufferedReader(zstandard.ZstdDecompressor().stream_reader(open(fn, 'rb')))
+    return open(fn, 'rb')
+
+
+def read_rows(fn, fields):
+    '''Yields the rows of the result file `fn` as tuples with the columns
+    `fields`, whatever the format and compression of the file.
+    '''
+    base = fn
+    for ext in COMPRESSIONS.values():
+        if ext and base.endswith(ext):
+            base = base[:-len(ext)]
+    f = open_decompressed(fn)
+    try:
+        if base.endswith('.jsonl'):
+            for line in f:
+                if line.strip():
+                    d = json.loads(line)
+                    yield tuple(d.get(field) for field in fields)
+        elif base.endswith('.tsv'):
+            header = f.readline().rstrip('\n').split('\t')
+            idx = [header.index(field) if field in header else None for field in fields]
+            for line in f:
+                values = line.rstrip('\n').split('\t')
+                # decoded like the strings of the json formats
+                yield tuple(None if i is None or values[i] == '\\N' else values[i].decode('utf-8') for i in idx)
+        else:
+            contents = f.read()
+            if contents:
+                for d in json.loads(contents):
+                    yield tuple(d.get(field) for field in fields)
+    finally:
+        f.close()
@@ -0,0 +1,109 @@
+'''
+
+User-sampled preview runs.
+
+With `--sample N`, only the edits of users whose id is a multiple of N are
+read, in the source query itself for the replicas and while parsing for the
+offline sources. Users are kept or dropped with all their edits, so the edit
+counts and hence the cohorts of the sampled editors are exact, and scaling
+the counts by N estimates those of a full run. The sample is deterministic:
+runs with the same N see the same users and can be compared with each other.
+
+Treating every user as kept with probability p = 1/N, an estimate N * k from
+k sampled editors has the variance k * N * (N - 1), which gives the normal
+approximation intervals of the report. City fractions are ratios of sampled
+edits; their binomial intervals assume independently sampled edits and
+understate the uncertainty, as the edits of an editor are sampled together.
+
+'''
+
+import csv
+import logging
+import math
+import os
+import tempfile
+
+import mysql_config
+
+logger = logging.getLogger(__name__)
+
+# two-sided 95% normal quantile
+Z = 1.96
+
+REPORT_TYPE = 'sample_report'
+REPORT_FIELDS = ['dataset', 'country', 'key', 'sampled', 'estimate', 'ci_low', 'ci_high']
+
+
+def scale(nest, factor):
+    '''Returns a copy of the (nested) dict of counts `nest`, with all counts
+    multiplied by `factor`
+    '''
+    return dict((k, scale(v, factor) if isinstance(v, dict) else v * factor) for (k, v) in nest.iteritems())
+
+
+def count_interval(estimate, n):
+    '''Returns the (low, high) 95% interval of the count `estimate` of a
+    1 in `n` user sample
+    '''
+    half = Z * math.sqrt(estimate * (n - 1))
+    return (max(0.0, estimate - half), estimate + half)
+
+
+def fraction_interval(fraction, edits):
+    '''Returns the (low, high) 95% interval of the fraction `fraction` of
+    `edits` sampled edits
+    '''
+    if not edits:
+        return (0.0, 1.0)
+    half = Z * math.sqrt(fraction * (1 - fraction) / edits)
+    return (max(0.0, fraction - half), min(1.0, fraction + half))
+
+
+def report_rows(datasets, n):
+    '''Yields the rows of the report for the scaled `datasets` of a 1 in `n`
+    user sample, as lists with the columns of `REPORT_FIELDS`
+    '''
+    fields = mysql_config.get_fields('active_editors_country')
+    for row in datasets['active_editors_country']():
+        row = dict(zip(fields, row))
+        (low, high) = count_interval(row['count'], n)
+        yield ['active_editors_country', row['country'], row['cohort'], row['count'] / n, row['count'], low, high]
+
+    fields = mysql_config.get_fields('active_editors_world')
+    for row in datasets['active_editors_world']():
+        row = dict(zip(fields, row))
+        (low, high) = count_interval(row['count'], n)
+        yield ['active_editors_world', '', row['cohort'], row['count'] / n, row['count'], low, high]
+
+    fields = mysql_config.get_fields('country_total_edit')
+    country_edits = {}
+    for row in datasets['country_total_edit']():
+        row = dict(zip(fields, row))
+        country_edits[row['country']] = row['edits'] / n
+
+    fields = mysql_config.get_fields('city_edit_fraction')
+    for row in datasets['city_edit_fraction']():
+        row = dict(zip(fields, row))
+        edits = country_edits.get(row['country'], 0)
+        (low, high) = fraction_interval(row['fraction'], edits)
+        yield ['city_edit_fraction', row['country'], row['city'], edits, row['fraction'], low, high]
+
+
+def write_report(wp_pr, datasets, opts):
+    '''Writes the estimates of the scaled `datasets` of `wp_pr` with their
+    confidence intervals to a tsv file next to the result files. Returns the
+    number of rows written.
+    '''
+    fn = mysql_config.get_filepath(REPORT_TYPE, wp_pr, opts, ext='tsv')
+    (fd, tmp_fn) = tempfile.mkstemp(dir=os.path.dirname(fn), prefix='.%s.' % os.path.basename(fn))
+    n = 0
+    with os.fdopen(fd, 'wb') as f:
+        writer = csv.writer(f, delimiter='\t', lineterminator='\n')
+        writer.writerow(REPORT_FIELDS)
+        for row in report_rows(datasets, opts['sample']):
+            writer.writerow([v.encode('utf-8') if isinstance(v, unicode) else v for v in row])
+            n += 1
+    os.chmod(tmp_fn, 0o644)
+    os.rename(tmp_fn, fn)
+    logger.debug('wrote %d estimates of the 1 in %d sample to %s', n, opts['sample'], fn)
+    return n
@@ -0,0 +1,142 @@
+'''
+
+External aggregation of per-editor edit counts.
+
+For the largest projects the `editors` dict built by `geo_coding.extract` is
+the peak-memory bottleneck: it grows with the number of distinct
+(user, country) pairs. `SpillingEditors` holds at most a configurable number
+of pairs in memory. When that is exceeded, the partial counts are written to
+a run file sorted by (user, country) and the dict is cleared. Iterating it
+merges all run files in one streaming pass, so memory stays bounded however
+large the project is. The `SpillingEditors` of the slices of one project
+share a `SpillBudget`, so that the limit holds for all of them together.
+
+'''
+
+import heapq
+import itertools
+import logging
+import os
+import shutil
+import tempfile
+
+from operator import itemgetter
+
+logger = logging.getLogger(__name__)
+
+# rough size in bytes of one (user, country) entry of the nested editors dict
+ENTRY_SIZE = 400
+
+
+def read_run(fn):
+    '''Yields the (user, country, edits) tuples of the run file `fn`'''
+    f = open(fn, 'rb')
+    for line in f:
+        (user, country, edits) = line.rstrip('\n').split('\t')
+        yield (int(user), country, int(edits))
+    f.close()
+
+
+class SpillBudget(object):
+    '''Bounds the number of (user, country) pairs held in memory by several
+    `SpillingEditors` together to `max_entries`
+    '''
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self.entries = 0
+        self.members = []
+
+    def check(self):
+        '''Spills the members holding the most pairs until at most half of
+        the budget is used, if it is exceeded
+        '''
+        if self.entries <= self.max_entries:
+            return
+        for member in sorted(self.members, key=len, reverse=True):
+            if self.entries <= self.max_entries / 2 or not len(member):
+                break
+            member.spill()
+
+
+class SpillingEditors(object):
+    '''Counts edits per (user, country) like the `editors` dict of
+    `geo_coding.extract`, spilling to sorted run files in `spill_dir` once
+    more pairs are held in memory than `budget` allows. `budget` is a
+    `SpillBudget` shared with other instances, or a maximum number of pairs
+    for this instance alone.
+
+    `iteritems` yields (user, {country : {'edits' : count}}) pairs in user
+    order, which is all `geo_coding.get_active_editors` needs.
+    '''
+
+    def __init__(self, budget, spill_dir=None):
+        if not isinstance(budget, SpillBudget):
+            budget = SpillBudget(budget)
+        self.budget = budget
+        budget.members.append(self)
+        self.spill_dir = spill_dir
+        self.editors = {}
+        self.entries = 0
+        self.runs = []
+        self.tmpdir = None
+
+    def add(self, user, country):
+        countries = self.editors.get(user)
+        if countries is None:
+            countries = self.editors[user] = {}
+        if country in countries:
+            countries[country] += 1
+        else:
+            countries[country] = 1
+            self.entries += 1
+            self.budget.entries += 1
+            self.budget.check()
+
+    def spill(self):
+        '''Writes the in-memory counts to a new sorted run file'''
+        if self.tmpdir is None:
+            self.tmpdir = tempfile.mkdtemp(prefix='geowiki_spill_', dir=self.spill_dir)
+        fn = os.path.join(self.tmpdir, 'run%05d' % len(self.runs))
+        f = open(fn, 'wb')
+        for user in sorted(self.editors):
+            countries = self.editors[user]
+            for country in sorted(countries):
+                f.write('%d\t%s\t%d\n' % (user, country, countries[country]))
+        f.close()
+        logger.debug('spilled %d (user, country) pairs to %s', self.entries, fn)
+        self.runs.append(fn)
+        self.editors = {}
+        self.budget.entries -= self.entries
+        self.entries = 0
+
+    def __len__(self):
+        '''Number of (user, country) pairs currently held in memory'''
+        return self.entries
+
+    def iteritems(self):
+        if not self.runs:
+            for (user, countries) in self.editors.iteritems():
+                yield (user, dict((country, {'edits': edits}) for (country, edits) in countries.iteritems()))
+            return
+
+        self.spill()
+        try:
+            merged = heapq.merge(*[read_run(fn) for fn in self.runs])
+            for (user, rows) in itertools.groupby(merged, key=itemgetter(0)):
+                ginfo = {}
+                for (u, country, edits) in rows:
+                    if country in ginfo:
+                        ginfo[country]['edits'] += edits
+                    else:
+                        ginfo[country] = {'edits': edits}
+                yield (user, ginfo)
+        finally:
+            self.close()
+
+    def close(self):
+        '''Removes the run files'''
+        if self.tmpdir is not None:
+            shutil.rmtree(self.tmpdir, ignore_errors=True)
+            self.tmpdir = None
+            self.runs = []
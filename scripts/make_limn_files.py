@@ -1,6 +1,8 @@
 #! /usr/bin/python
 
 import argparse
+import hashlib
+import json
 import logging
 import pprint
 import itertools
@@ -8,16 +10,21 @@ import operator
 from operator import itemgetter
 import re
 import os
+import sys
+from collections import defaultdict
 import MySQLdb as sql
-#import sqlite3 as sql
+import sqlite3
 import MySQLdb.cursors
 import multiprocessing
+import time
 
 import limnpy
 #import gcat
-import wikipandas
 import pandas as pd
 
+from geowiki import country_groups
+from geowiki import mysql_config
+
 root_logger = logging.getLogger()
 ch = logging.StreamHandler()
 formatter = logging.Formatter('[%(levelname)s]\t[%(name)s]\t[%(funcName)s:%(lineno)d]\t%(message)s')
@@ -36,35 +43,210 @@ META_DATA_GLOBAL_SOUTH_FIELD = 'Global South'
 
 LIMN_GROUP = 'gp'
 
+# tables read by this script, as ids of mysql_config.DEST_TABLE_NAMES
+SOURCE_TABLE_IDS = ['active_editors_country', 'active_editors_world',
+                    'rollup_project', 'rollup_top_countries', 'rollup_group']
+
+
+def use_sqlite():
+    """Switch the queries of this module to sqlite3 (qmark paramstyle and
+    sqlite SQL). Has to be called before the worker processes are forked.
+    """
+    global sql
+    sql = sqlite3
+
+
+def dict_factory(cursor, row):
+    """sqlite3 row factory returning dicts like MySQLdb's DictCursor"""
+    return dict((column[0], value) for (column, value) in zip(cursor.description, row))
+
+
+def connect(args):
+    """Return a connection to the source database of `args`: the sqlite file
+    `args.sqlite` if given, otherwise the mysql database `args.source_db_name`.
+    Rows of its cursors are dicts in both cases.
+    """
+    if args.sqlite:
+        db = sqlite3.connect(args.sqlite)
+        db.row_factory = dict_factory
+        # the database is only read, and each worker process has its own
+        # connection, so give every connection a large page cache
+        db.execute('PRAGMA cache_size=-%d' % (args.sqlite_cache_mb * 1024))
+        db.execute('PRAGMA temp_store=MEMORY')
+        return db
+    return MySQLdb.connect(read_default_file=args.source_sql_cnf, db=args.source_db_name, cursorclass=MySQLdb.cursors.DictCursor)
+
+
+def get_cursor(db, streaming=False):
+    """Return a dict cursor of `db`. With `streaming`, rows are fetched from
+    the server as they are read instead of all at once.
+    """
+    if streaming and not isinstance(db, sqlite3.Connection):
+        return db.cursor(MySQLdb.cursors.SSDictCursor)
+    return db.cursor()
+
+
+def ensure_indexes(db):
+    """Create the indexes of mysql_config.DEST_TABLE_INDEXES on the tables
+    of the sqlite database `db`, in case it was not built by
+    restore_from_files.py
+    """
+    existing = set(row['name'] for row in db.execute("SELECT name FROM sqlite_master WHERE type = 'table'"))
+    for table_id in SOURCE_TABLE_IDS:
+        table_name = mysql_config.DEST_TABLE_NAMES[table_id]
+        if table_name not in existing:
+            continue
+        for command in mysql_config.get_index_commands(table_id, table_name):
+            db.execute(command)
+    db.execute('ANALYZE')
+    db.commit()
+
+
+def check_schema(cursor):
+    """Exit with an error if the country table has no window_days column, i.e.
+    has not been migrated by process_data.py yet
+    """
+    try:
+        cursor.execute('SELECT window_days FROM erosen_geocode_active_editors_country LIMIT 1')
+        cursor.fetchall()
+    except Exception:
+        logger.exception('the source tables predate the window_days column')
+        logger.error('run geowiki/process_data.py without --skip_manage_schema to migrate them')
+        sys.exit(1)
+
+
+def execute(cursor, query, params=()):
+    """Execute `query` on `cursor` and log how long it took"""
+    start = time.time()
+    cursor.execute(query, params)
+    logger.debug('query took %.3fs: %s', time.time() - start, ' '.join(query.split()))
+
+
+def wikified_project():
+    """Return the SQL expression appending 'wiki' to the project column"""
+    if sql.paramstyle == 'qmark':
+        return "project || 'wiki'"
+    return "CONCAT(project, 'wiki')"
 
-def make_limn_rows(rows, col_prim_key, count_key='count'):
-    if not rows:
-        return
-    logger.debug('making limn rows from rows with keys:%s', rows[0].keys())
-    logger.debug('col_prim_key: %s', col_prim_key)
-    logger.debug('len(rows): %s', len(rows))
-    rows = map(dict, rows)  # need real dicts, not sqlite.Rows
 
-    filtered = filter(lambda r: r['cohort'] in ['all', '5+', '100+'], rows)
+def make_limn_rows(rows, col_prim_key, count_key='count'):
+    """Pivot `rows` into the DataFrame limnpy.DataSource takes: indexed by
+    date (the `end` of each row), with one '<col_prim_key value> (<cohort>)'
+    column per key and plotted cohort, holding the `count_key` values.
 
-    transformed = []
-    # logger.debug('transforming rows to {\'date\' : end, \'%s (cohort)\' : count}', col_prim_key)
-    for row in filtered:
-        if col_prim_key in row:
-            transformed.append({'date': row['end'], '%s (%s)' % (row[col_prim_key], row['cohort']): row[count_key]})
+    `rows` can be cursor results (dicts or sqlite3.Rows) or a DataFrame.
+    Returns None if there are no rows to plot.
+    """
+    if isinstance(rows, pd.DataFrame):
+        df = rows
+    else:
+        rows = list(rows)
+        if not rows:
+            return None
+        if isinstance(rows[0], dict):
+            df = pd.DataFrame.from_records(rows)
         else:
-            logger.debug('row does not contain col_prim_key (%s): %s', col_prim_key, row)
-
-    logger.debug('len(transformed): %s', len(transformed))
-    limn_rows = []
-    for date, date_rows in itertools.groupby(sorted(transformed, key=itemgetter('date')), key=itemgetter('date')):
-        limn_row = {'date': date}
-        for date_row in date_rows:
-            limn_row.update(date_row)
-        limn_rows.append(limn_row)
+            df = pd.DataFrame.from_records(rows, columns=rows[0].keys())
+    logger.debug('making limn rows from rows with keys:%s', list(df.columns))
+    logger.debug('col_prim_key: %s', col_prim_key)
+    logger.debug('len(rows): %s', len(df))
+    if col_prim_key not in df.columns:
+        logger.debug('rows do not contain col_prim_key (%s)', col_prim_key)
+        return None
+
+    df = df[df['cohort'].isin(['all', '5+', '100+'])].dropna(subset=[col_prim_key])
+    if df.empty:
+        return None
+    columns = ['%s (%s)' % (key, cohort) for (key, cohort) in zip(df[col_prim_key], df['cohort'])]
+    long_df = pd.DataFrame({'date': pd.to_datetime(df['end']).values, 'column': columns, 'value': df[count_key].values})
+    # later rows win for a (date, column) pair
+    limn_rows = long_df.pivot_table(index='date', columns='column', values='value', aggfunc='last')
+    limn_rows.columns.name = None
+    logger.debug('len(limn_rows): %s', len(limn_rows))
     return limn_rows
 
 
+def since_clause(since):
+    """Return the condition restricting a query to the windows ending after
+    `since`, or '' if `since` is None. Goes right after `window_days = 30`.
+    """
+    if since is None:
+        return ''
+    return ' AND end > %s' % ('?' if sql.paramstyle == 'qmark' else '%s')
+
+
+def since_params(since):
+    return [] if since is None else [since]
+
+
+def get_datafile(limn_id, basedir):
+    return os.path.join(basedir, 'datafiles', '%s.csv' % limn_id)
+
+
+def read_datafile(limn_id, basedir):
+    """Return the existing Limn datafile of `limn_id` as a DataFrame like
+    those of make_limn_rows, or None if there is no datafile yet.
+    """
+    fn = get_datafile(limn_id, basedir)
+    if not os.path.exists(fn):
+        return None
+    return pd.read_csv(fn, index_col='date', parse_dates=['date'])
+
+
+def get_last_date(limn_id, basedir):
+    """Return the last date in the Limn datafile of `limn_id`, or None"""
+    df = read_datafile(limn_id, basedir)
+    if df is None or df.empty:
+        return None
+    return df.index.max().date()
+
+
+def merge_limn_rows(old_rows, new_rows):
+    """Merge the limn rows `new_rows` into `old_rows`, the values of
+    `new_rows` winning for dates present in both
+    """
+    if old_rows is None:
+        return new_rows
+    if new_rows is None:
+        return old_rows
+    return new_rows.combine_first(old_rows).sort_index(axis=1)
+
+
+def content_hash(limn_id, limn_name, limn_rows):
+    # values read back from a datafile are floats, so hash all numbers as floats
+    data = limn_rows.sort_index(axis=1).astype(float).to_csv()
+    return hashlib.sha1(json.dumps([limn_id, limn_name, data])).hexdigest()
+
+
+def write_source(limn_id, limn_name, limn_rows, basedir, incremental=False, since=None):
+    """Write the Limn datasource and datafile of `limn_rows` and return the
+    limnpy DataSource.
+
+    Keyword arguments:
+    incremental -- bool. Keep a hash of the content next to the datafile and
+        return None without writing anything if it did not change.
+    since -- date or None. If given, `limn_rows` only hold the dates after
+        `since` and are merged into the existing datafile.
+    """
+    if since is not None:
+        limn_rows = merge_limn_rows(read_datafile(limn_id, basedir), limn_rows)
+    if limn_rows is None or limn_rows.empty:
+        logger.warning('no rows for datasource: %s', limn_id)
+        return None
+    if incremental:
+        digest = content_hash(limn_id, limn_name, limn_rows)
+        hash_fn = os.path.join(basedir, 'datafiles', '.%s.sha1' % limn_id)
+        if os.path.exists(hash_fn) and open(hash_fn).read() == digest:
+            logger.debug('datasource %s did not change, not rewriting it', limn_id)
+            return None
+    source = limnpy.DataSource(limn_id, limn_name, limn_rows, limn_group=LIMN_GROUP)
+    source.write(basedir=basedir)
+    if incremental:
+        with open(hash_fn, 'w') as f:
+            f.write(digest)
+    return source
+
+
 def write_default_graphs(source, limn_id, limn_name, basedir):
     if source:
         source_id = source['id']
@@ -76,29 +258,47 @@ def write_default_graphs(source, limn_id, limn_name, basedir):
             limnpy.write_graph(limn_id + '_' + cohort_id, cohort_name + ' ' + limn_name, [source], source_cols, basedir=basedir)
 
 
-def write_project_mysql(proj, cursor, basedir, country_graphs=False):
+def write_project_mysql(proj, cursor, basedir, country_graphs=False, incremental=False):
     # TODO: This function's structure got copy/pasted to
     # write_project_summed_mysql. Please apply fixes to this function also to
     # write_project_summed_mysql.
     logger.debug('writing project datasource for: %s', proj)
-    limn_id = proj + '_all'
-    limn_name = '%s Editors by Country' % proj.upper()
+    since = get_last_date(proj + '_all', basedir) if incremental else None
 
     if sql.paramstyle == 'qmark':
-        query = """ SELECT * FROM erosen_geocode_active_editors_country WHERE project=? AND end = start + INTERVAL 30 day"""
+        query = """ SELECT * FROM erosen_geocode_active_editors_country WHERE project=? AND window_days = 30"""
         logger.debug('making query: %s', query)
     elif sql.paramstyle == 'format':
-        query = """ SELECT * FROM erosen_geocode_active_editors_country WHERE project=%s AND end = start + INTERVAL 30 day"""
-    cursor.execute(query, [proj])
+        query = """ SELECT * FROM erosen_geocode_active_editors_country WHERE project=%s AND window_days = 30"""
+    query += since_clause(since)
+    execute(cursor, query, [proj] + since_params(since))
     proj_rows = cursor.fetchall()
 
     logger.debug('len(proj_rows): %d', len(proj_rows))
     if not proj_rows and sql.paramstyle == 'format':
-        logger.debug('GOT NUTHIN!: %s', query % proj)
+        logger.debug('GOT NUTHIN!: %s', query % tuple([proj] + since_params(since)))
         return
+    write_project_source(proj, proj_rows, basedir, country_graphs=country_graphs, incremental=incremental, since=since)
+
+
+def write_project_source(proj, proj_rows, basedir, country_graphs=False, incremental=False, since=None):
+    """Write out the datasource of editors by country for one project
+
+    Keyword arguments:
+    proj -- string. The name of the project in the database
+        (e.g.: 'en' for enwiki).
+    proj_rows -- cursor rows or DataFrame of the country table for `proj`.
+    basedir -- string. Path to the data repository to store the computed
+        data in.
+    country_graphs -- bool. Also write one graph per country.
+    incremental, since -- see write_source.
+    """
+    limn_id = proj + '_all'
+    limn_name = '%s Editors by Country' % proj.upper()
     limn_rows = make_limn_rows(proj_rows, 'country')
-    source = limnpy.DataSource(limn_id, limn_name, limn_rows, limn_group=LIMN_GROUP)
-    source.write(basedir=basedir)
+    source = write_source(limn_id, limn_name, limn_rows, basedir, incremental=incremental, since=since)
+    if source is None:
+        return
     source.write_graph(basedir=basedir)
 
     # construct single column graphs
@@ -109,7 +309,7 @@ def write_project_mysql(proj, cursor, basedir, country_graphs=False):
             source.write_graph(metric_ids=[country], basedir=basedir, title=title, graph_id=graph_id)
 
 
-def write_project_summed_mysql(proj, cursor, basedir):
+def write_project_summed_mysql(proj, cursor, basedir, rollups=False, incremental=False):
     """Write out per project sums of editors
 
     Keyword arguments:
@@ -118,36 +318,64 @@ def write_project_summed_mysql(proj, cursor, basedir):
     cursor -- database connection. Used to obtain the data.
     basedir -- string. Path to the data repository to store the computed
         data in.
+    rollups -- bool. Read the sums from the rollup table written by
+        process_data instead of summing the country table.
+    incremental -- bool. Only query the windows after the last date of the
+        existing datafile, see write_source.
     """
     # TODO: dumb copy/paste of write_project_mysql to get daily per project
     # active editor counts. Please apply fixes to this function also to
     # write_project_mysql.
     logger.debug('writing summed project datasource for: %s', proj)
-    limn_id = proj + 'wiki_editor_counts'
-    limn_name = proj + 'wiki editors (Tentative)'
+    since = get_last_date(proj + 'wiki_editor_counts', basedir) if incremental else None
 
-    if sql.paramstyle == 'qmark':
-        query = """SELECT cohort, end, CONCAT(project, 'wiki') AS wikified_project, SUM(count)
+    if rollups:
+        query = """SELECT cohort, end, %s AS wikified_project, count AS `SUM(count)`
+                    FROM erosen_geocode_rollup_project
+                    WHERE project = %%s AND window_days = 30""" % wikified_project()
+        if sql.paramstyle == 'qmark':
+            query = query.replace('%s', '?')
+    elif sql.paramstyle == 'qmark':
+        query = """SELECT cohort, end, %s AS wikified_project, SUM(count)
                     FROM erosen_geocode_active_editors_country
-                    WHERE project = ? AND end = start + INTERVAL 30 day
-                    GROUP BY cohort, end, project"""
+                    WHERE project = ? AND window_days = 30
+                    GROUP BY cohort, end, project""" % wikified_project()
         logger.debug('making query: %s', query)
     elif sql.paramstyle == 'format':
         query = """SELECT cohort, end, CONCAT(project, 'wiki') AS wikified_project, SUM(count)
                     FROM erosen_geocode_active_editors_country
-                    WHERE project = %s AND end = start + INTERVAL 30 day
+                    WHERE project = %s AND window_days = 30
                     GROUP BY cohort, end, project"""
-    cursor.execute(query, [proj])
+    query = query.replace('window_days = 30', 'window_days = 30' + since_clause(since))
+    execute(cursor, query, [proj] + since_params(since))
     proj_rows = cursor.fetchall()
 
     logger.debug('len(proj_rows): %d', len(proj_rows))
     if not proj_rows and sql.paramstyle == 'format':
-        logger.debug('No results for query: %s', query % proj)
+        logger.debug('No results for query: %s', query % tuple([proj] + since_params(since)))
         return
+    write_project_summed_source(proj, proj_rows, basedir, incremental=incremental, since=since)
+
+
+def write_project_summed_source(proj, proj_rows, basedir, incremental=False, since=None):
+    """Write out the datasource and graph of the per project sums of editors
+
+    Keyword arguments:
+    proj -- string. The name of the project in the database
+        (e.g.: 'en' for enwiki).
+    proj_rows -- cursor rows or DataFrame with the columns cohort, end,
+        wikified_project and SUM(count).
+    basedir -- string. Path to the data repository to store the computed
+        data in.
+    incremental, since -- see write_source.
+    """
+    limn_id = proj + 'wiki_editor_counts'
+    limn_name = proj + 'wiki editors (Tentative)'
     limn_rows = make_limn_rows(proj_rows, 'wikified_project', 'SUM(count)')
-    source = limnpy.DataSource(limn_id, limn_name, limn_rows, limn_group=LIMN_GROUP)
-    source.write(basedir=basedir)
-    graph = source.get_graph(metric_ids=['%swiki (5+)' % project])
+    source = write_source(limn_id, limn_name, limn_rows, basedir, incremental=incremental, since=since)
+    if source is None:
+        return
+    graph = source.get_graph(metric_ids=['%swiki (5+)' % proj])
     graph.graph['desc'] = """This graph currently mis-reports by counting each
 editor once for each country associated to the IP addresses used by
 the editor.
@@ -156,145 +384,297 @@ the editor.
     graph.write(basedir)
 
 
-def write_project_top_k_mysql(proj, cursor, basedir, k=10):
+def write_project_top_k_mysql(proj, cursor, basedir, k=10, rollups=False, incremental=False):
     logger.debug('entering')
-    limn_id = proj + '_top%d' % k
-    limn_name = '%s Editors by Country (top %d)' % (proj.upper(), k)
-
+    # the top countries rollup only narrows down the candidates to the
+    # countries that ranked among the top --rollup_top_k of some window, as it
+    # has no rows for the other windows. The candidates are ranked and their
+    # series read from the full history in the country table.
+    candidates = []
+    if rollups:
+        query = """SELECT DISTINCT country
+                    FROM erosen_geocode_rollup_top_countries
+                    WHERE project=%s AND cohort='all' AND window_days = 30"""
+        if sql.paramstyle == 'qmark':
+            query = query.replace('%s', '?')
+        execute(cursor, query, (proj,))
+        candidates = map(itemgetter('country'), cursor.fetchall())
+        logger.debug('proj: %s, top k candidates: %s', proj, candidates)
+    table = 'erosen_geocode_active_editors_country'
     if sql.paramstyle == 'qmark':
+        candidate_clause = ' AND country IN (%s)' % ', '.join(['?'] * len(candidates)) if candidates else ''
         top_k_query = """SELECT country
-                    FROM erosen_geocode_active_editors_country
-                    WHERE project=? AND cohort='all' AND end = start+INTERVAL 30 day
+                    FROM %s
+                    WHERE project=? AND cohort='all' AND window_days = 30%s
                     GROUP BY country
                     ORDER BY SUM(count) DESC, end DESC, country
-                    LIMIT ?"""
+                    LIMIT ?""" % (table, candidate_clause)
     elif sql.paramstyle == 'format':
+        candidate_clause = ' AND country IN (%s)' % ', '.join(['%s'] * len(candidates)) if candidates else ''
         top_k_query = """SELECT country
-                    FROM erosen_geocode_active_editors_country
-                    WHERE project=%s AND cohort='all' AND end = start+INTERVAL 30 day
+                    FROM %s
+                    WHERE project=%%s AND cohort='all' AND window_days = 30%s
                     GROUP BY country
                     ORDER BY SUM(count) DESC, end DESC, country
-                    LIMIT %s"""
-        logger.debug('top k query: %s', top_k_query % (proj, k))
-    cursor.execute(top_k_query, (proj, k))  # mysqldb first converts all args to str
+                    LIMIT %%s""" % (table, candidate_clause)
+        logger.debug('top k query: %s', top_k_query % tuple([proj] + candidates + [k]))
+    execute(cursor, top_k_query, [proj] + candidates + [k])  # mysqldb first converts all args to str
     top_k = map(itemgetter('country'), cursor.fetchall())
     logger.debug('proj: %s, top_k countries: %s', proj, top_k)
     if not top_k:
         logger.warning('not country edits found for proj: %s', proj)
         return
 
+    since = None
+    if incremental:
+        # new data can change the top k countries, in which case the
+        # datasource is rebuilt from the full history
+        datafile = read_datafile(proj + '_top%d' % k, basedir)
+        columns = set() if datafile is None else set(column.rsplit(' (', 1)[0] for column in datafile.columns)
+        if columns == set(top_k):
+            since = get_last_date(proj + '_top%d' % k, basedir)
+        else:
+            logger.info('top %d countries of %s changed, rebuilding', k, proj)
+
     if sql.paramstyle == 'qmark':
         country_fmt = ', '.join([' ? '] * len(top_k))
-        query = """ SELECT * FROM erosen_geocode_active_editors_country WHERE project=? AND country IN %s AND end = start + INTERVAL 30 day"""
-        query = query % country_fmt
+        query = """ SELECT * FROM %s WHERE project=? AND country IN (%s) AND window_days = 30"""
+        query = query % (table, country_fmt)
     elif sql.paramstyle == 'format':
         country_fmt = '(%s)' % ', '.join([' %s '] * len(top_k))
         logger.debug('country_fmt: %s', country_fmt)
-        query = """ SELECT * FROM erosen_geocode_active_editors_country WHERE project=%s  AND end = start + INTERVAL 30 day AND country IN """
+        query = """ SELECT * FROM %s WHERE project=%%s  AND window_days = 30 AND country IN """ % table
         query = query + country_fmt
         args = [proj]
         args.extend(top_k)
         print_query = query % tuple(args)
         logger.debug('top_k edit count query: %s', print_query)
-    cursor.execute(query, [proj, ] + top_k)
+    query += since_clause(since)
+    execute(cursor, query, [proj, ] + top_k + since_params(since))
     proj_rows = cursor.fetchall()
 
     logger.debug('retrieved %d rows', len(proj_rows))
+    write_project_top_k_source(proj, proj_rows, basedir, k, incremental=incremental, since=since)
+
+
+def write_project_top_k_source(proj, proj_rows, basedir, k, incremental=False, since=None):
+    limn_id = proj + '_top%d' % k
+    limn_name = '%s Editors by Country (top %d)' % (proj.upper(), k)
     limn_rows = make_limn_rows(proj_rows, 'country')
-    source = limnpy.DataSource(limn_id, limn_name, limn_rows, limn_group=LIMN_GROUP)
-    source.write(basedir=basedir)
+    source = write_source(limn_id, limn_name, limn_rows, basedir, incremental=incremental, since=since)
+    if source is None:
+        return
     source.write_graph(basedir=basedir)
 
 
-def write_overall_mysql(projects, cursor, basedir):
+def top_k_frame(proj_df, k):
+    """Return the rows of `proj_df` for the `k` countries with the most
+    editors over all windows, ranked like the top k query of
+    write_project_top_k_mysql.
+    """
+    totals = proj_df[proj_df['cohort'] == 'all'].groupby('country').agg({'count': 'sum', 'end': 'max'})
+    # SUM(count) DESC, end DESC, country
+    ranked = sorted(totals.index)
+    ranked.sort(key=lambda country: (totals['count'][country], totals['end'][country]), reverse=True)
+    return proj_df[proj_df['country'].isin(ranked[:k])]
+
+
+def summed_frame(proj, proj_df):
+    """Return the per cohort and end sums of `proj_df`, with the columns of
+    the summed query of write_project_summed_mysql.
+    """
+    summed = proj_df.groupby(['cohort', 'end'])['count'].sum().reset_index()
+    summed = summed.rename(columns={'count': 'SUM(count)'})
+    summed['wikified_project'] = proj + 'wiki'
+    return summed
+
+
+def write_projects_bulk(projects, cursor, basedir_private, basedir_public, k=10, incremental=False):
+    """Write the per project datasources of all `projects` from a single
+    scan of the country table.
+
+    The rows are streamed ordered by project, so only the rows of one
+    project are held in a DataFrame at a time, and the top k countries and
+    per project sums are computed in memory instead of with further queries.
+
+    Keyword arguments:
+    projects -- list of project names to write datasources for.
+    cursor -- unbuffered dict cursor (see get_cursor), so that the table is
+        not loaded into memory at once.
+    """
+    projects = set(projects)
+    query = """SELECT project, country, cohort, end, count
+               FROM erosen_geocode_active_editors_country
+               WHERE window_days = 30 AND cohort IN ('all', '5+', '100+')
+               ORDER BY project"""
+    execute(cursor, query)
+    written = set()
+    for proj, rows in itertools.groupby(iter(cursor.fetchone, None), key=itemgetter('project')):
+        if proj not in projects:
+            continue
+        logger.info('processing project: %s (%d/%d)', proj, len(written) + 1, len(projects))
+        proj_df = pd.DataFrame(map(dict, rows))
+        write_project_source(proj, proj_df, basedir_private, incremental=incremental)
+        write_project_top_k_source(proj, top_k_frame(proj_df, k), basedir_private, k, incremental=incremental)
+        write_project_summed_source(proj, summed_frame(proj, proj_df), basedir_public, incremental=incremental)
+        written.add(proj)
+    for proj in sorted(projects - written):
+        logger.warning('no country rows found for project: %s', proj)
+
+
+def write_overall_mysql(projects, cursor, basedir, incremental=False):
     logger.info('writing overall datasource')
     limn_id = 'overall_by_lang'
     limn_name = 'Overall Editors by Language'
+    since = get_last_date(limn_id, basedir) if incremental else None
 
     query = """ SELECT * FROM erosen_geocode_active_editors_world"""
-    cursor.execute(query)
+    if since is not None:
+        query += ' WHERE 1' + since_clause(since)
+    execute(cursor, query, since_params(since))
     overall_rows = cursor.fetchall()
 
     limn_rows = make_limn_rows(overall_rows, 'project')
-    monthly_limn_rows = filter(lambda r: r['date'].day == 1, limn_rows)
+    monthly_limn_rows = None if limn_rows is None else limn_rows[limn_rows.index.day == 1]
     #logger.debug('overall limn_rows: %s', pprint.pformat(limn_rows))
-    source = limnpy.DataSource(limn_id, limn_name, limn_rows, limn_group=LIMN_GROUP)
-    source.write(basedir=basedir)
-    source.write_graph(basedir=basedir)
+    source = write_source(limn_id, limn_name, limn_rows, basedir, incremental=incremental, since=since)
+    if source is not None:
+        source.write_graph(basedir=basedir)
+
+    write_source(limn_id + '_monthly', limn_name + ' Monthly', monthly_limn_rows, basedir, incremental=incremental, since=since)
+
+
+def iter_rows(rows):
+    """Iterate over `rows`, a plain iterable of dicts or a collection with a
+    mongo style find()
+    """
+    if hasattr(rows, 'find'):
+        return rows.find()
+    return rows
 
-    monthly_source = limnpy.DataSource(limn_id + '_monthly', limn_name + ' Monthly', monthly_limn_rows, limn_group=LIMN_GROUP)
-    monthly_source.write(basedir=basedir)
 
+def merge_rows(group_keys, rows, merge_key='count', merge_red_fn=operator.__add__, red_init=0, fill_empty=True):
+    """Reduce the `merge_key` values of `rows` per combination of `group_keys`
+    values in a single pass over `rows`.
 
-def merge_rows(group_keys, rows, merge_key='count', merge_red_fn=operator.__add__, red_init=0):
+    With `fill_empty`, the result holds every combination of the distinct
+    values of the group keys, with `red_init` for combinations without rows,
+    as the original product-and-find implementation returned.
+    """
     logger.debug('merging rows by grouping on: %s', group_keys)
     logger.debug('reducing field %s with fn: %s, init_val: %s', merge_key, merge_red_fn, red_init)
-    group_vals = map(rows.distinct, group_keys)
-    #logger.debug('group_vals: %s', pprint.pformat(dict(zip(group_keys, group_vals))))
+    merged = {}
+    group_vals = [[] for key in group_keys]
+    seen = [set() for key in group_keys]
+    for row in iter_rows(rows):
+        if not all(key in row for key in group_keys):
+            continue
+        group_val = tuple(row[key] for key in group_keys)
+        for (vals, seen_vals, val) in zip(group_vals, seen, group_val):
+            if val not in seen_vals:
+                seen_vals.add(val)
+                vals.append(val)
+        merged[group_val] = merge_red_fn(merged.get(group_val, red_init), row[merge_key])
+
+    combinations = itertools.product(*group_vals) if fill_empty else merged.iterkeys()
     merged_rows = []
-    for group_val in itertools.product(*group_vals):
+    for group_val in combinations:
         group_probe = dict(zip(group_keys, group_val))
-        group_rows = rows.find(group_probe)
-        merge_set = map(itemgetter(merge_key), group_rows)
-        merged_val = reduce(merge_red_fn, merge_set, red_init)
-        group_probe[merge_key] = merged_val
+        group_probe[merge_key] = merged.get(group_val, red_init)
         merged_rows.append(group_probe)
     return merged_rows
 
 
 def join(join_key, coll1, coll2):
+    """Inner join of the rows of `coll1` and `coll2` on `join_key`, by hashing
+    the rows of both on their `join_key` value
+    """
     logger.debug('joining...')
-    intersection = set(coll1.distinct(join_key)) & set(coll2.distinct(join_key))
+    index1 = defaultdict(list)
+    for row in iter_rows(coll1):
+        if join_key in row:
+            index1[row[join_key]].append(row)
+    index2 = defaultdict(list)
+    for row in iter_rows(coll2):
+        if join_key in row:
+            index2[row[join_key]].append(row)
     joined_rows = []
-    for val in intersection:
-        probe = {join_key: val}
-        pairs = itertools.product(coll1.find(probe), coll2.find(probe))
-        for row1, row2 in pairs:
+    for val, rows1 in index1.iteritems():
+        for row1, row2 in itertools.product(rows1, index2.get(val, [])):
             joined_rows.append(dict(row1.items() + row2.items()))
     logger.debug('done')
     return joined_rows
 
 
-def write_group_mysql(group_key, country_data, cursor, basedir):
+def write_group_mysql(group_key, country_data, cursor, basedir, rollups=False, incremental=False):
     logger.debug('writing group with group_key: %s', group_key)
-    country_data = filter(lambda row: group_key in row, country_data)
-    country_data = sorted(country_data, key=itemgetter(group_key))
-    groups = itertools.groupby(country_data, key=itemgetter(group_key))
-    groups = dict(map(lambda (key, rows): (key, map(itemgetter(META_DATA_COUNTRY_FIELD), rows)), groups))
-    #logger.debug(pprint.pformat(groups))
-    all_rows = []
-    for group_val, countries in groups.items():
-        logger.debug('processing group_val: %s', group_val)
-        if sql.paramstyle == 'qmark':
-            group_query = """SELECT end, cohort, SUM(count)
-                         FROM erosen_geocode_active_editors_country
-                         WHERE country IN (%s)
-                         AND end = start + INTERVAL 30 day
-                         GROUP BY end, cohort"""
-            countries_fmt = ', '.join([' ? '] * len(countries))
-        elif sql.paramstyle == 'format':
-            group_query = """SELECT end, cohort, SUM(count)
-                         FROM erosen_geocode_active_editors_country
-                         WHERE country IN (%s)
-                         AND end = start + INTERVAL 30 day
-                         GROUP BY end, cohort"""
-            countries_fmt = ', '.join([' %s '] * len(countries))
-        group_query_fmt = group_query % countries_fmt
-        cursor.execute(group_query_fmt, tuple(countries))
-        group_rows = cursor.fetchall()
-        group_rows = map(dict, group_rows)
-        for row in group_rows:
-            row.update({group_key: group_val})
-        all_rows.extend(group_rows)
-    #logger.debug('groups_rows: %s', group_rows)
+    limn_id = group_key.replace(' ', '_').lower()
+    limn_name = group_key.title()
+    since = get_last_date(limn_id, basedir) if incremental else None
+    if rollups and group_key != META_DATA_COUNTRY_FIELD:
+        write_group_rollup_mysql(group_key, cursor, basedir, incremental=incremental, since=since)
+        return
+    load_country_groups(group_key, country_data, cursor)
+    group_query = """SELECT g.group_name, c.end, c.cohort, SUM(c.count) AS `SUM(count)`
+                     FROM erosen_geocode_active_editors_country c
+                     JOIN geowiki_country_groups g ON c.country = g.country
+                     WHERE c.window_days = 30%s
+                     GROUP BY g.group_name, c.end, c.cohort""" % since_clause(since)
+    execute(cursor, group_query, since_params(since))
+    all_rows = map(dict, cursor.fetchall())
+    for row in all_rows:
+        row[group_key] = row.pop('group_name')
+
+    limn_rows = make_limn_rows(all_rows, group_key, count_key='SUM(count)')
+    logger.debug('limn_rows: %s', limn_rows)
+    source = write_source(limn_id, limn_name, limn_rows, basedir, incremental=incremental, since=since)
+    if source is not None:
+        source.write_graph(basedir=basedir)
+
+
+def load_country_groups(group_key, country_data, cursor):
+    """Load the country -> group mapping `group_key` of `country_data` into
+    the temporary table geowiki_country_groups of the connection of `cursor`,
+    so that all groups are summed with a single join.
+    """
+    placeholder = '?' if sql.paramstyle == 'qmark' else '%s'
+    cursor.execute("""CREATE TEMPORARY TABLE IF NOT EXISTS geowiki_country_groups (
+                          country VARCHAR(255) NOT NULL,
+                          group_name VARCHAR(255) NOT NULL,
+                          PRIMARY KEY (country))""")
+    cursor.execute('DELETE FROM geowiki_country_groups')
+    groups = [(row[META_DATA_COUNTRY_FIELD], row[group_key]) for row in country_data
+              if not pd.isnull(row.get(group_key)) and not pd.isnull(row.get(META_DATA_COUNTRY_FIELD))]
+    cursor.executemany('REPLACE INTO geowiki_country_groups (country, group_name) VALUES (%s, %s)' % (placeholder, placeholder), groups)
+    logger.debug('loaded %d countries for group_key: %s', len(groups), group_key)
+
+
+def write_group_rollup_mysql(group_key, cursor, basedir, incremental=False, since=None):
+    """Write out the sums of editors per group of countries from the group
+    rollup table. process_data has to be run with a --country_groups file
+    containing the grouping `group_key`.
+    """
+    query = """SELECT end, cohort, group_name, SUM(count)
+               FROM erosen_geocode_rollup_group
+               WHERE group_set = %s AND window_days = 30
+               GROUP BY end, cohort, group_name"""
+    if sql.paramstyle == 'qmark':
+        query = query.replace('%s', '?')
+    query = query.replace('window_days = 30', 'window_days = 30' + since_clause(since))
+    execute(cursor, query, [group_key] + since_params(since))
+    all_rows = map(dict, cursor.fetchall())
+    if not all_rows and since is None:
+        logger.warning('no group rollup rows found for grouping: %s', group_key)
+        return
+    for row in all_rows:
+        row[group_key] = row['group_name']
 
     limn_rows = make_limn_rows(all_rows, group_key, count_key='SUM(count)')
     limn_id = group_key.replace(' ', '_').lower()
     limn_name = group_key.title()
-    logger.debug('limn_rows: %s', limn_rows)
-    source = limnpy.DataSource(limn_id, limn_name, limn_rows, limn_group=LIMN_GROUP)
-    source.write(basedir=basedir)
-    source.write_graph(basedir=basedir)
+    source = write_source(limn_id, limn_name, limn_rows, basedir, incremental=incremental, since=since)
+    if source is not None:
+        source.write_graph(basedir=basedir)
 
 
 def get_countries(project, cursor):
@@ -355,6 +735,12 @@ def parse_args():
         default=True,
         help='use a multiprocessing pool to execute per-language analysis in parallel'
     )
+    parser.add_argument(
+        '--processes',
+        type=int,
+        default=20,
+        help='number of worker processes of --parallel, each with its own database connection'
+    )
     parser.add_argument(
         '--source_sql_cnf',
         type=os.path.expanduser,
@@ -372,6 +758,68 @@ def parse_args():
         '(default: staging)'
     )
 
+    parser.add_argument(
+        '--sqlite',
+        metavar='FILE',
+        help='read the data from the sqlite database FILE, e.g. one built by '
+        'restore_from_files.py --sqlite, instead of the mysql database of --source_sql_cnf. '
+        'Missing indexes are created first'
+    )
+    parser.add_argument(
+        '--sqlite_cache_mb',
+        type=int,
+        default=256,
+        help='page cache size in MB of each connection to the --sqlite database'
+    )
+
+    parser.add_argument(
+        '--bulk',
+        action='store_true',
+        default=False,
+        help='write the per project datasources from a single scan of the country table, '
+        'grouped in memory, instead of running several queries per project'
+    )
+    parser.add_argument(
+        '--skip_projects',
+        action='store_true',
+        default=False,
+        help='only write the cross-project datasources, e.g. when process_data.py updates the per project '
+        'datafiles itself with --limn_basedir_private and --limn_basedir_public'
+    )
+    parser.add_argument(
+        '--incremental',
+        action='store_true',
+        default=False,
+        help='only query the windows after the last date of each existing datafile and append them, '
+        'and do not rewrite datasources and graphs whose content did not change. '
+        'With --bulk only the latter applies'
+    )
+    parser.add_argument(
+        '--country_cache',
+        default=country_groups.DEFAULT_CACHE_FN,
+        help='json file in which the regional classification of countries from meta is cached'
+    )
+    parser.add_argument(
+        '--country_cache_ttl',
+        type=float,
+        default=24,
+        help='hours for which the cached classification is used without checking meta for changes'
+    )
+    parser.add_argument(
+        '--offline',
+        action='store_true',
+        default=False,
+        help='always use the cached classification, never fetch it from meta'
+    )
+    parser.add_argument(
+        '--rollups',
+        action='store_true',
+        default=False,
+        help='read per project sums and country groups from the rollup tables written by '
+        'process_data instead of aggregating the country table, and only rank the countries '
+        'of the top countries rollup for the top k'
+    )
+
     args = parser.parse_args()
     logger.info(pprint.pformat(vars(args), indent=2))
     return args
@@ -385,28 +833,76 @@ def get_projects():
     return projects
 
 
+# database cursor of a worker process of the parallel path, opened once by
+# init_worker and reused for all projects the worker processes
+worker_cursor = None
+
+
+def init_worker(worker_args):
+    """Pool initializer: keep the arguments and open the connection of a
+    worker process
+    """
+    global args, worker_cursor
+    args = worker_args
+    if args.sqlite:
+        use_sqlite()
+    worker_cursor = get_cursor(connect(args))
+
+
 def process_project_par((project, basedir_private, basedir_public)):
+    """Write the datasources of `project` in a worker process set up by
+    init_worker. Returns (project, success, seconds).
+
+    Failures are logged and reported instead of raised, so that one project
+    does not abort the others. The connection is reopened after a failure,
+    as the failure may have left it unusable.
+    """
+    global worker_cursor
+    start = time.time()
     try:
         logger.info('processing project: %s', project)
-        db = sql.connect(read_default_file=args.source_sql_cnf, db=args.source_db_name)
-        cursor = db.cursor(MySQLdb.cursors.DictCursor)
-
-        # db = sql.connect('/home/erosen/src/editor-geocoding/geowiki.sqlite')
-
-        write_project_mysql(project, cursor, basedir_private)
-        write_project_top_k_mysql(project, cursor, basedir_private, k=args.k)
-        write_project_summed_mysql(project, cursor, basedir_public)
-        #write_project_country_language(project, cursor, basedir_private)
-    except:
-        logger.exception('caught exception in process:')
-        raise
+        write_project_mysql(project, worker_cursor, basedir_private, incremental=args.incremental)
+        write_project_top_k_mysql(project, worker_cursor, basedir_private, k=args.k, rollups=args.rollups, incremental=args.incremental)
+        write_project_summed_mysql(project, worker_cursor, basedir_public, rollups=args.rollups, incremental=args.incremental)
+        #write_project_country_language(project, worker_cursor, basedir_private)
+    except Exception:
+        logger.exception('failed to process project: %s', project)
+        try:
+            worker_cursor = get_cursor(connect(args))
+        except Exception:
+            logger.exception('could not reconnect')
+        return project, False, time.time() - start
+    return project, True, time.time() - start
+
+
+def process_projects_par(projects, args):
+    """Write the datasources of `projects` with a pool of `args.processes`
+    worker processes, each with its own connection. Returns the list of
+    projects that failed.
+    """
+    pool = multiprocessing.Pool(args.processes, initializer=init_worker, initargs=(args,))
+    tasks = itertools.izip(projects, itertools.repeat(args.basedir_private), itertools.repeat(args.basedir_public))
+    failed = []
+    times = []
+    for i, (project, success, seconds) in enumerate(pool.imap_unordered(process_project_par, tasks)):
+        if success:
+            times.append((seconds, project))
+            logger.info('processed project: %s in %.1fs (%d/%d)', project, seconds, i + 1, len(projects))
+        else:
+            failed.append(project)
+    pool.close()
+    pool.join()
+    if times:
+        logger.info('slowest projects: %s', ', '.join('%s (%.1fs)' % (project, seconds)
+                                                      for (seconds, project) in sorted(times, reverse=True)[:10]))
+    return failed
 
 
 def process_project(project, cursor, basedir_private, basedir_public):
     logger.info('processing project: %s (%d/%d)', project, i, len(projects))
-    write_project_mysql(project, cursor, basedir_private)
-    write_project_top_k_mysql(project, cursor, basedir_private, k=args.k)
-    write_project_summed_mysql(project, cursor, basedir_public)
+    write_project_mysql(project, cursor, basedir_private, incremental=args.incremental)
+    write_project_top_k_mysql(project, cursor, basedir_private, k=args.k, rollups=args.rollups, incremental=args.incremental)
+    write_project_summed_mysql(project, cursor, basedir_public, rollups=args.rollups, incremental=args.incremental)
     #write_project_country_language(project, cursor, basedir_private)
 
 
@@ -492,38 +988,51 @@ Also, this graph currently only considers the following projects
 if __name__ == '__main__':
     args = parse_args()
 
-    db = MySQLdb.connect(read_default_file=args.source_sql_cnf, db=args.source_db_name, cursorclass=MySQLdb.cursors.DictCursor)
-    # db = sql.connect('/home/erosen/src/editor-geocoding/geowiki.sqlite')
-    # db.row_factory = sql.Row
-    cursor = db.cursor()
+    if args.sqlite:
+        use_sqlite()
+    db = connect(args)
+    if args.sqlite:
+        ensure_indexes(db)
+    cursor = get_cursor(db)
+    check_schema(cursor)
 
-    write_project_mysql('en', cursor, args.basedir_private, country_graphs=True)
+    if not args.skip_projects:
+        write_project_mysql('en', cursor, args.basedir_private, country_graphs=True, incremental=args.incremental)
 
     # # use metadata from Google Drive doc which lets us group by country
     #country_data = gcat.get_file(META_DATA_TITLE, sheet=META_DATA_SHEET, fmt='dict', usecache=False)
-    country_data_df = wikipandas.get_table(
-        title='List of countries by regional classification',
-        site='meta.wikimedia.org',
-        table_idx=0
-    )
-    country_data = [dict(series) for idx, series in country_data_df.iterrows()]
+    # the regional classification on meta, cached locally
+    (country_data, _, groups_changed) = country_groups.get_classification(
+        args.country_cache, ttl=args.country_cache_ttl * 3600, offline=args.offline)
     # logger.debug('typ(country_data): %s', type(country_data))
     # logger.info('country_data[0].keys: %s', country_data[0].keys())
 
-    write_group_mysql(META_DATA_GLOBAL_SOUTH_FIELD, country_data, cursor, args.basedir_private)
-    write_group_mysql(META_DATA_REGION_FIELD, country_data, cursor, args.basedir_private)
+    # a changed classification moves countries between groups, so the group
+    # series have to be rebuilt from the full history
+    group_incremental = args.incremental and not groups_changed
+    write_group_mysql(META_DATA_GLOBAL_SOUTH_FIELD, country_data, cursor, args.basedir_private, rollups=args.rollups, incremental=group_incremental)
+    write_group_mysql(META_DATA_REGION_FIELD, country_data, cursor, args.basedir_private, rollups=args.rollups, incremental=group_incremental)
 
-    write_group_mysql(META_DATA_COUNTRY_FIELD, country_data, cursor, args.basedir_private)
+    write_group_mysql(META_DATA_COUNTRY_FIELD, country_data, cursor, args.basedir_private, incremental=group_incremental)
 
     projects = get_projects()
-    if not args.parallel or sql.threadsafety < 2:
+    failed = []
+    if args.skip_projects:
+        logger.info('not writing per project datasources')
+    elif args.bulk:
+        write_projects_bulk(projects, get_cursor(db, streaming=True), args.basedir_private, args.basedir_public,
+                            k=args.k, incremental=args.incremental)
+    elif not args.parallel or args.processes < 2:
         for i, project in enumerate(projects):
             logger.info('processing project: %s (%d/%d)', project, i, len(projects))
             process_project(project, cursor, args.basedir_private, args.basedir_public)
     else:
-        pool = multiprocessing.Pool(20)
-        pool.map_async(process_project_par, itertools.izip(projects, itertools.repeat(args.basedir_private), itertools.repeat(args.basedir_public))).get(99999)
+        failed = process_projects_par(projects, args)
 
-    write_overall_mysql(projects, cursor, args.basedir_private)
+    write_overall_mysql(projects, cursor, args.basedir_private, incremental=args.incremental)
     plot_gs_editor_fraction(args.basedir_private)
     plot_active_editor_totals(args.basedir_private, args.basedir_public)
+
+    if failed:
+        logger.error('failed to process %d projects: %s', len(failed), ', '.join(sorted(failed)))
+        sys.exit(1)
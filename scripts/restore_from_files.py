@@ -1,6 +1,9 @@
 #!/usr/bin/python
 
 import argparse
+import datetime
+import hashlib
+import itertools
 import MySQLdb
 import json
 import pprint
@@ -8,8 +11,12 @@ import os
 import logging
 import re
 import sqlite3
+import time
 
-from geowiki.mysql_config import DEST_TABLES, DEST_TABLE_NAMES
+from multiprocessing import Pool
+
+from geowiki import result_files
+from geowiki.mysql_config import DEST_TABLES, DEST_TABLE_KEYS, DEST_TABLE_NAMES, FILE_TYPES, get_fields, get_create_command, get_index_commands
 
 root_logger = logging.getLogger()
 ch = logging.StreamHandler()
@@ -61,12 +68,9 @@ def parse_args():
         help='{table id : table names} pairs in `dest_sql` db to use for storing each type of data'
     )
 
-    default_patterns = {
-        'active_editors_country': 'geowiki_\w+_country_active_editors_\d{8}_\d{8}.json',
-        'active_editors_world': 'geowiki_\w+_world_active_editors_\d{8}_\d{8}.json',
-        'city_edit_fraction': 'geowiki_\w+_city_fractions_\d{8}_\d{8}.json',
-        'country_total_edit': 'geowiki_\w+_country_total_edits_\d{8}_\d{8}.json',
-    }
+    default_patterns = dict(
+        (table_id, 'geowiki_\w+_%s_\d{8}_\d{8}\.(json|jsonl|tsv)(\.gz|\.zst)?$' % _type)
+        for (table_id, _type) in FILE_TYPES.items())
 
     parser.add_argument(
         '--patterns',
@@ -89,6 +93,34 @@ def parse_args():
         help='drectory in which to search for files matching the patterns which will then be used to restore the corresponding mysql table'
     )
 
+    parser.add_argument(
+        '--processes',
+        type=int,
+        default=4,
+        help='number of processes used to parse files'
+    )
+
+    parser.add_argument(
+        '--batch_size',
+        type=int,
+        default=1000,
+        help='number of rows sent to the database per insert statement'
+    )
+
+    parser.add_argument(
+        '--manifest_table',
+        default='geowiki_restore_manifest',
+        help='table in the destination database which records the files that have already been restored, '
+        'so that repeated runs only load new or modified files'
+    )
+
+    parser.add_argument(
+        '--force',
+        action='store_true',
+        default=False,
+        help='restore all matching files, even those recorded in --manifest_table'
+    )
+
     args = parser.parse_args()
     opts = vars(args)
     logger.info('opts: %s', pprint.pformat(opts))
@@ -100,56 +132,167 @@ def get_cursor(opts):
         db = MySQLdb.connect(read_default_file=opts['dest_sql_cnf'], db=opts['dest_db_name'])
     else:
         db = sqlite3.connect(opts['sqlite_db_file'])
+        # the database can be rebuilt from the files, so trade durability
+        # for load speed
+        db.execute('PRAGMA journal_mode=MEMORY')
+        db.execute('PRAGMA synchronous=OFF')
+        db.execute('PRAGMA cache_size=-262144')
+        db.execute('PRAGMA temp_store=MEMORY')
     return db.cursor()
 
 
-def restore_table(table_id, opts, cursor):
+def get_placeholder(opts):
+    return '?' if opts['sqlite'] else '%s'
+
+
+def create_manifest(opts, cursor):
+    command = """CREATE TABLE IF NOT EXISTS %s (
+        table_name VARCHAR(255) NOT NULL,
+        path_sha1 CHAR(40) NOT NULL,
+        path TEXT,
+        mtime DOUBLE,
+        row_count INT,
+        PRIMARY KEY (table_name, path_sha1))""" % opts['manifest_table']
+    cursor.execute(command)
+    cursor.connection.commit()
+
+
+def get_manifest(table_name, opts, cursor):
+    '''Returns {path : mtime} for the files already restored into `table_name`'''
+    cursor.execute('SELECT path, mtime FROM %s WHERE table_name = %s' % (opts['manifest_table'], get_placeholder(opts)),
+                   (table_name,))
+    return dict(cursor.fetchall())
+
+
+# dirs and files of process_data.py --sample previews, which hold scaled
+# estimates instead of production results
+SAMPLE_RE = re.compile(r'.*_sample\d+(_|$)')
+
+
+def find_files(pattern, opts):
+    fps = []
+    for (dirpath, dirnames, filenames) in os.walk(opts['basedir']):
+        dirnames[:] = [dn for dn in dirnames if not SAMPLE_RE.match(dn)]
+        for fn in filenames:
+            if re.match(pattern, fn) and not SAMPLE_RE.match(fn):
+                fps.append(os.path.join(dirpath, fn))
+    return sorted(fps)
+
+
+def load_file(args):
+    '''Parses one result file into a list of row tuples. Runs in the worker
+    processes, so it only takes and returns picklable values.
+    '''
+    (fp, table_id) = args
+    mtime = os.path.getmtime(fp)
+    fields = get_fields(table_id)
+    rows = list(result_files.read_rows(fp, fields))
+    # files written before window_days was stored do not have it
+    if rows and rows[0][fields.index('window_days')] is None:
+        rows = map(fill_window_days(fields), rows)
+    return (fp, mtime, rows)
+
+
+def fill_window_days(fields):
+    (start_idx, end_idx, window_idx) = map(fields.index, ['start', 'end', 'window_days'])
+    parse = lambda d: datetime.datetime.strptime(str(d)[:10], '%Y-%m-%d')
+
+    def fill(row):
+        row = list(row)
+        row[window_idx] = (parse(row[end_idx]) - parse(row[start_idx])).days
+        return tuple(row)
+    return fill
+
+
+def insert_rows(query, rows, batch_size, cursor):
+    rows = iter(rows)
+    while True:
+        batch = list(itertools.islice(rows, batch_size))
+        if not batch:
+            break
+        cursor.executemany(query, batch)
+
+
+def restore_table(table_id, opts, cursor, pool):
     table_name = opts['table_names'][table_id]
     pattern = opts['patterns'][table_id]
     logging.info('restoring table_id: %s to table_name: %s, from files in %s with pattern: %s', table_id, table_name, opts['basedir'], pattern)
 
-    rows = []
-    for (dirpath, dirnames, filenames) in os.walk(opts['basedir']):
-        for fn in filenames:
-            #logging.debug('re.match(\'%s\', \'%s\')', pattern, fn)
-            if re.match(pattern, fn):
-                # logging.debug('found matching file: %s', fn)
-                fp = os.path.join(dirpath, fn)
-                contents = open(fp, 'r').read()
-                if contents:
-                    rows.extend(json.loads(contents))
-                else:
-                    logging.warning('found empty file: %s', fn)
-
-    fields = DEST_TABLES[table_id].keys()
-    fields.remove('ts')
+    fields = get_fields(table_id)
     if opts['sqlite']:
-        field_str = ',\n'.join(map(' '.join, DEST_TABLES[table_id].items()))
-        command = 'CREATE TABLE IF NOT EXISTS %s (%s)' % (table_name, field_str)
+        command = get_create_command(table_id, table_name)
         logging.debug('creating sqlite table with command:\n%s', command)
         cursor.execute(command)
+        columns = [row[1] for row in cursor.execute('PRAGMA table_info(%s)' % table_name)]
+        if 'window_days' not in columns:
+            logging.info('adding and backfilling window_days in %s', table_name)
+            cursor.execute('ALTER TABLE %s ADD COLUMN window_days INT' % table_name)
+            cursor.execute('UPDATE %s SET window_days = CAST(julianday(end) - julianday(start) AS INT)' % table_name)
+        if 'grouping' in columns:
+            logging.info('renaming grouping to group_set in %s', table_name)
+            cursor.execute('ALTER TABLE %s RENAME COLUMN grouping TO group_set' % table_name)
+        has_key = any(row[5] for row in cursor.execute('PRAGMA table_info(%s)' % table_name))
+        key_index = '%s_key' % table_name
+        if not has_key and key_index not in [row[1] for row in cursor.execute('PRAGMA index_list(%s)' % table_name)]:
+            # sqlite can not add a primary key to an existing table, but
+            # REPLACE INTO also replaces rows on a unique index
+            key = ', '.join(DEST_TABLE_KEYS[table_id])
+            logging.info('adding a unique index on (%s) to %s, dropping duplicate rows', key, table_name)
+            cursor.execute('DELETE FROM %s WHERE rowid NOT IN (SELECT MAX(rowid) FROM %s GROUP BY %s)' % (
+                table_name, table_name, key))
+            cursor.execute('CREATE UNIQUE INDEX %s ON %s (%s)' % (key_index, table_name, key))
         cursor.connection.commit()
-        dict_fmt = ', '.join(map(lambda f: ':%s' % f, fields))
-    else:
-        dict_fmt = ', '.join(map(lambda f: '%%(%s)s' % f, fields))
-    query_fmt = """REPLACE INTO %s (%s) VALUES (%s);""" % (table_name, ','.join(fields), dict_fmt)
-    if rows:
-        logging.debug('loaded %d rows', len(rows))
-        logging.debug('type(rows[0][\'start\']): %s', type(rows[0]['start']))
-        logging.debug('query: %s', query_fmt % rows[0])
-        batch_size = 1000
-        for i in range(0, len(rows), batch_size):
-            cursor.executemany(query_fmt, rows[i:i + batch_size])
-            cursor.connection.commit()
-            logging.debug('commited %d rows', i + batch_size)
+    placeholder = get_placeholder(opts)
+    query = """REPLACE INTO %s (%s) VALUES (%s)""" % (table_name, ','.join(fields), ', '.join([placeholder] * len(fields)))
+    manifest_query = """REPLACE INTO %s (table_name, path_sha1, path, mtime, row_count) VALUES (%s)""" % (
+        opts['manifest_table'], ', '.join([placeholder] * 5))
+
+    fps = find_files(pattern, opts)
+    manifest = {} if opts['force'] else get_manifest(table_name, opts, cursor)
+    new_fps = [fp for fp in fps if manifest.get(fp) != os.path.getmtime(fp)]
+    logging.info('found %d matching files, %d of them new or modified', len(fps), len(new_fps))
+
+    t0 = time.time()
+    n_rows = 0
+    # parse files in the pool while inserting the previous ones; files are
+    # handed out in windows so that parsed files do not pile up in memory
+    window = 4 * opts['processes']
+    for i in range(0, len(new_fps), window):
+        tasks = [(fp, table_id) for fp in new_fps[i:i + window]]
+        for (fp, mtime, rows) in pool.imap(load_file, tasks):
+            if not rows:
+                logging.warning('found empty file: %s', fp)
+            insert_rows(query, rows, opts['batch_size'], cursor)
+            # the file is recorded in the same transaction as its rows
+            cursor.execute(manifest_query, (table_name, hashlib.sha1(fp).hexdigest(), fp, mtime, len(rows)))
+            if not opts['sqlite']:
+                cursor.connection.commit()
+            n_rows += len(rows)
+        logging.debug('restored %d rows from %d files', n_rows, min(i + window, len(new_fps)))
+
+    if opts['sqlite']:
+        # sqlite loads the whole table in one transaction and only builds the
+        # indexes once the rows are in
+        t_index = time.time()
+        for command in get_index_commands(table_id, table_name):
+            cursor.execute(command)
+        cursor.connection.commit()
+        logging.debug('built indexes of %s in %.1fs', table_name, time.time() - t_index)
+    elapsed = time.time() - t0
+    logging.info('restored %d rows from %d files into %s in %.1fs (%.0f rows/s)',
+                 n_rows, len(new_fps), table_name, elapsed, n_rows / elapsed if elapsed else 0)
 
 
 def main():
     opts = parse_args()
     cursor = get_cursor(opts)
+    create_manifest(opts, cursor)
+    pool = Pool(opts['processes'])
     for table_id in opts['tables']:
         logger.debug('restoring table_id: %s, table_name:%s', table_id, opts['table_names'][table_id])
-        restore_table(table_id, opts, cursor)
+        restore_table(table_id, opts, cursor, pool)
+    pool.close()
+    pool.join()
 
 if __name__ == '__main__':
     main()
@@ -25,6 +25,10 @@ setup(
         "geoip",
         "gcat == 0.1.0",
     ],
+    extras_require={
+        # reading extract files written with --write_extract
+        'extract': ["numpy >= 1.9"],
+    },
     entry_points={
         'console_scripts': ['geowiki=geowiki.process_data:main']
     },